@@ -0,0 +1,166 @@
+/*
+ * Compiled decoder of the chainstate coins (Bitcoin Core 0.15 onwards), the counterpart of utils.decode_coin. It is
+ * optional: utils.py falls back to the pure Python decoder when this module is not built. Build it with
+ *
+ *     python setup.py build_ext --inplace
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#define NSPECIALSCRIPTS 6
+
+/*
+ * Reads a MSB base-128 varint, see utils.read_b128. Returns 0 on success, 1 if the value does not fit in 64 bits and -1
+ * (with an IndexError set, as the Python decoder) if the varint is truncated.
+ */
+static int
+read_b128(const unsigned char *data, Py_ssize_t size, Py_ssize_t *offset, uint64_t *value)
+{
+    uint64_t n = 0;
+
+    for (;;) {
+        unsigned char d;
+
+        if (*offset >= size) {
+            PyErr_SetString(PyExc_IndexError, "truncated varint");
+            return -1;
+        }
+        if (n > (UINT64_MAX >> 7))
+            return 1;
+        d = data[(*offset)++];
+        n = n << 7 | (d & 0x7F);
+        if (d & 0x80) {
+            if (n == UINT64_MAX)
+                return 1;
+            n++;
+        } else {
+            *value = n;
+            return 0;
+        }
+    }
+}
+
+/* See utils.txout_decompress. Returns 0 on success, 1 if the amount does not fit in 64 bits. */
+static int
+txout_decompress(uint64_t x, uint64_t *amount)
+{
+    uint64_t n;
+    int e;
+
+    if (x == 0) {
+        *amount = 0;
+        return 0;
+    }
+    x--;
+    e = (int)(x % 10);
+    x /= 10;
+    if (e < 9) {
+        uint64_t d = (x % 9) + 1;
+        x /= 9;
+        n = x * 10 + d;
+    } else {
+        n = x + 1;
+    }
+    while (e > 0) {
+        if (n > UINT64_MAX / 10)
+            return 1;
+        n *= 10;
+        e--;
+    }
+    *amount = n;
+    return 0;
+}
+
+/*
+ * Decodes a coin with the pure Python decoder (utils.py_decode_coin). Used for the coins with values over 64 bits,
+ * which are not found in a chainstate, so that both decoders give the same result for any input.
+ */
+static PyObject *
+fallback_decode_coin(PyObject *coin)
+{
+    PyObject *utils, *result;
+
+    utils = PyImport_ImportModule("utils");
+    if (utils == NULL)
+        return NULL;
+    result = PyObject_CallMethod(utils, "py_decode_coin", "O", coin);
+    Py_DECREF(utils);
+    return result;
+}
+
+static PyObject *
+decode_coin(PyObject *self, PyObject *args)
+{
+    Py_buffer coin;
+    const unsigned char *data;
+    Py_ssize_t size, offset = 0;
+    uint64_t code, value, amount, out_type, data_size;
+    int status;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "y*:decode_coin", &coin))
+        return NULL;
+    data = (const unsigned char *)coin.buf;
+    size = coin.len;
+
+    status = read_b128(data, size, &offset, &code);
+    if (status == 0)
+        status = read_b128(data, size, &offset, &value);
+    if (status == 0)
+        status = read_b128(data, size, &offset, &out_type);
+    if (status == 0)
+        status = txout_decompress(value, &amount);
+    if (status < 0)
+        goto done;
+    if (status > 0) {
+        result = fallback_decode_coin(PyTuple_GET_ITEM(args, 0));
+        goto done;
+    }
+
+    if (out_type < 2) {
+        data_size = 20;
+    } else if (out_type < NSPECIALSCRIPTS) {
+        /* 1 byte for the type + 32 bytes of data */
+        data_size = 33;
+        offset--;
+    } else {
+        data_size = out_type - NSPECIALSCRIPTS;
+    }
+
+    /* The Python decoder asserts that the script ends the coin */
+    if (data_size != (uint64_t)(size - offset)) {
+        PyErr_SetString(PyExc_AssertionError, "unexpected coin size");
+        goto done;
+    }
+
+    result = Py_BuildValue(
+        "(KKKKy#)",
+        (unsigned long long)(code >> 1),
+        (unsigned long long)(code & 0x01),
+        (unsigned long long)amount,
+        (unsigned long long)out_type,
+        (const char *)data + offset, (Py_ssize_t)data_size);
+
+done:
+    PyBuffer_Release(&coin);
+    return result;
+}
+
+static PyMethodDef coins_methods[] = {
+    {"decode_coin", decode_coin, METH_VARARGS,
+     "decode_coin(coin) -> (height, coinbase, amount, out_type, script)\n\n"
+     "Decodes a raw (already de-obfuscated) coin, see utils.decode_coin."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef coins_module = {
+    PyModuleDef_HEAD_INIT, "_coins", "Compiled decoder of the chainstate coins.", -1, coins_methods
+};
+
+PyMODINIT_FUNC
+PyInit__coins(void)
+{
+    return PyModule_Create(&coins_module);
+}
@@ -0,0 +1,397 @@
+import os
+import shutil
+import tempfile
+import sqlite3
+import heapq
+from array import array
+from operator import itemgetter
+import multiprocessing
+from utils import split_key_range, clone_chainstate, encode_address_key, UINT64
+from extsort import external_aggregate, external_sort_by_amount
+from chainstate import ChainstateReader, ADDRESS_TYPES
+from stats import Stats
+
+# Aggregation of the (address key, amount, height) outputs of the chainstate into balances per address. A backend takes
+# the outputs and options, and returns the (address key, amount, height) per address; the height is the one of the last
+# output read for the address.
+
+# The worker processes of aggregate_parallel are spawned rather than forked: the parent has usually opened the
+# chainstate already (best block, --live copy), and a forked child would inherit the LevelDB state without its
+# background compaction thread. Closing a database whose compaction it scheduled would then wait forever.
+CONTEXT = multiprocessing.get_context('spawn')
+
+# Page cache of the sqlite database used by the sqlite backend
+SQLITE_CACHE_KIB = 64 * 1024
+
+
+class Balances(object):
+    """
+    Amount and last height per address key. Keys are mapped to a row index, amounts and heights are kept in arrays
+    rather than in a Python list per address, which keeps the memory footprint per address small.
+    """
+
+    __slots__ = ('index', 'amounts', 'heights')
+
+    def __init__(self):
+        self.index = dict()
+        self.amounts = array(UINT64)
+        self.heights = array('L')
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, key, amount, height):
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.amounts)
+            self.amounts.append(amount)
+            self.heights.append(height)
+        else:
+            self.amounts[i] += amount
+            self.heights[i] = height
+
+    def update(self, other):
+        amounts = other.amounts
+        heights = other.heights
+        for key, i in other.index.items():
+            self.add(key, amounts[i], heights[i])
+
+    def items(self):
+        amounts = self.amounts
+        heights = self.heights
+        for key, i in self.index.items():
+            yield key, amounts[i], heights[i]
+
+    def sorted_items(self, descending=False, min_balance=1):
+        """ Iterates over the addresses with at least min_balance, sorted by amount. The row numbers are sorted rather
+        than (key, amount, height) tuples, which takes less than half the memory.
+        """
+
+        amounts = self.amounts
+        heights = self.heights
+        keys = [None] * len(amounts)
+        for key, i in self.index.items():
+            keys[i] = key
+        rows = [i for i in range(len(amounts)) if amounts[i] >= min_balance]
+        rows.sort(key=amounts.__getitem__, reverse=descending)
+        for i in rows:
+            yield keys[i], amounts[i], heights[i]
+
+    def select(self, top=None, min_balance=1, sort=None):
+        """ Selects the addresses like select_balances, a full sort being done on the row numbers (see sorted_items).
+        """
+
+        if sort is not None and top is None:
+            return self.sorted_items(sort == 'DESC', max(min_balance, 1))
+        return select_balances(self.items(), top, min_balance, sort)
+
+    def __getstate__(self):
+        return self.index, self.amounts, self.heights
+
+    def __setstate__(self, state):
+        self.index, self.amounts, self.heights = state
+
+
+def aggregate(add_iter, balances=None):
+    if balances is None:
+        balances = Balances()
+    add = balances.add
+    for key, val, height in add_iter:
+        add(key, val, height)
+    return balances
+
+
+def scan_range(task):
+    fin_name, clone, version, types, start, stop, timed, keys, tuning = task
+    # LevelDB can be opened by one process only, every worker reads its own copy (in the scratch directory of
+    # aggregate_parallel, which removes it if the worker does not).
+    try:
+        clone_chainstate(fin_name, clone)
+        stats = Stats(timed=timed, progress=False)
+        reader = ChainstateReader(clone, version, tuning)
+        balances = aggregate(reader.iter_outputs(types, start=start, stop=stop, stats=stats, keys=keys))
+        return balances, stats
+    finally:
+        shutil.rmtree(clone, ignore_errors=True)
+
+
+def aggregate_parallel(reader, types, jobs, stats=None, progress=None, keys=None, scratch=None):
+    """ Aggregates the outputs in memory, the chainstate being scanned by several worker processes, every one reading
+    a key range of its own copy of the chainstate (see utils.clone_chainstate).
+
+    :param reader: The chainstate.
+    :type reader: ChainstateReader
+    :param types: Script types to be included.
+    :type types: iterable
+    :param jobs: Number of worker processes.
+    :type jobs: int
+    :param stats: Stats the counters and timers of the workers are added to.
+    :type stats: Stats
+    :param progress: Function called with the number of scanned and total key ranges after every key range.
+    :type progress: function
+    :param keys: Address keys the outputs are restricted to, all by default.
+    :type keys: frozenset
+    :param scratch: Directory where the copies are made, in a temporary directory removed at the end. It should be on
+        the same filesystem as the chainstate so that the table files are hard-linked rather than copied. Defaults to
+        the system temporary directory.
+    :type scratch: str
+    :return: The balances.
+    :rtype: Balances
+    """
+
+    if stats is None:
+        stats = Stats()
+    tmpdir = tempfile.mkdtemp(prefix='chainstate-', dir=scratch)
+    tasks = [
+        (reader.path, os.path.join(tmpdir, str(i)), reader.version, types, start, stop, stats.timed, keys,
+         reader.tuning)
+        for i, (start, stop) in enumerate(split_key_range(reader.prefix, jobs))
+    ]
+
+    # Partial aggregates are merged in key order, so that the last height of every address is the same as when the
+    # chainstate is scanned by a single process.
+    balances = Balances()
+    pool = CONTEXT.Pool(jobs)
+    try:
+        for i, (part, part_stats) in enumerate(pool.imap(scan_range, tasks)):
+            if stats.timed:
+                stats.clock('aggregate')
+            balances.update(part)
+            stats.merge(part_stats)
+            if stats.timed:
+                # Waiting for the workers is not accounted, their own time is in part_stats
+                stats.clock(None)
+            if progress is not None:
+                progress(i + 1, len(tasks))
+    finally:
+        # Every result is in when the scan completes, otherwise the workers are not waited for
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return balances
+
+
+def select_balances(add_iter, top=None, min_balance=1, sort=None):
+    """ Selects the addresses with at least min_balance and, if top is given, the top addresses by amount only. The
+    top addresses are kept in a bounded heap, the records are never sorted as a whole.
+
+    :param add_iter: The (address key, amount, height) per address.
+    :type add_iter: iterable
+    :param top: Number of addresses with the highest amounts to keep, all by default.
+    :type top: int
+    :param min_balance: Lowest amount (satoshi) of the addresses kept.
+    :type min_balance: int
+    :param sort: ASC or DESC to sort the addresses by amount; unsorted by default, or DESC for the top addresses.
+    :type sort: str
+    :return: The selected (address key, amount, height).
+    :rtype: iterable
+    """
+
+    min_balance = max(min_balance, 1)
+    add_iter = (record for record in add_iter if record[1] >= min_balance)
+    if top is not None:
+        records = heapq.nlargest(top, add_iter, key=itemgetter(1))
+        if sort == 'ASC':
+            records.reverse()
+        return records
+    if sort is not None:
+        return sorted(add_iter, key=itemgetter(1), reverse=sort == 'DESC')
+    return add_iter
+
+
+def memory_backend(add_iter, sort=None, top=None, min_balance=1):
+    """ Aggregates the outputs in memory.
+
+    :param add_iter: The (address key, amount, height) outputs.
+    :type add_iter: iterable
+    :param sort: ASC or DESC to sort the addresses by amount, unsorted by default.
+    :type sort: str
+    :param top: Number of addresses with the highest amounts to keep, all by default (see select_balances).
+    :type top: int
+    :param min_balance: Lowest amount (satoshi) of the addresses kept.
+    :type min_balance: int
+    """
+
+    return aggregate(add_iter).select(top, min_balance, sort)
+
+
+def extsort_backend(add_iter, mem_budget=1024 * 1024 * 1024, sort=None, tmpdir=None, top=None, min_balance=1):
+    """ Aggregates the outputs by sorting and merging temporary files, see extsort.external_aggregate.
+
+    :param add_iter: The (address key, amount, height) outputs.
+    :type add_iter: iterable
+    :param mem_budget: Memory (in bytes) used before spilling to disk.
+    :type mem_budget: int
+    :param sort: ASC or DESC to sort the addresses by amount, unsorted by default.
+    :type sort: str
+    :param tmpdir: Directory of the temporary files, defaults to the system temporary directory.
+    :type tmpdir: str
+    :param top: Number of addresses with the highest amounts to keep, all by default (see select_balances).
+    :type top: int
+    :param min_balance: Lowest amount (satoshi) of the addresses kept.
+    :type min_balance: int
+    """
+
+    add_iter = external_aggregate(add_iter, mem_budget, tmpdir)
+    if top is not None:
+        return select_balances(add_iter, top, min_balance, sort)
+    min_balance = max(min_balance, 1)
+    add_iter = ((key, val, height) for key, val, height in add_iter if val >= min_balance)
+    if sort is not None:
+        add_iter = external_sort_by_amount(add_iter, mem_budget, descending=sort == 'DESC', tmpdir=tmpdir)
+    return add_iter
+
+
+def sqlite_backend(add_iter, path=None, sort=None, top=None, min_balance=1):
+    """ Aggregates the outputs in a sqlite database.
+
+    :param add_iter: The (address key, amount, height) outputs.
+    :type add_iter: iterable
+    :param path: Path to the database file, which is kept with the encoded addresses in its balance table; by default
+        a temporary database is used and removed.
+    :type path: str
+    :param sort: ASC or DESC to sort the addresses by amount, unsorted by default.
+    :type sort: str
+    :param top: Number of addresses with the highest amounts to keep, all by default (see select_balances).
+    :type top: int
+    :param min_balance: Lowest amount (satoshi) of the addresses kept, also in the kept database.
+    :type min_balance: int
+    """
+
+    if path:
+        dbfile = path
+    else:
+        fd, dbfile = tempfile.mkstemp()
+        os.close(fd)
+
+    with sqlite3.connect(dbfile) as conn:
+        curr = conn.cursor()
+
+        # The database is a scratch space (or a copy of the output), there is nothing to recover after a crash.
+        curr.execute('PRAGMA journal_mode = OFF')
+        curr.execute('PRAGMA synchronous = OFF')
+        curr.execute('PRAGMA temp_store = FILE')
+        curr.execute('PRAGMA cache_size = -%d' % SQLITE_CACHE_KIB)
+
+        curr.execute(
+            """
+            DROP TABLE IF EXISTS balance
+            """
+        )
+
+        curr.execute(
+            """
+            CREATE TABLE balance (
+                    address TEXT,
+                    amount BIGINT NOT NULL,
+                    height BIGINT NOT NULL,
+                    address_key BLOB PRIMARY KEY
+            )
+            """
+        )
+
+        # The outputs are first appended to an unindexed staging table and aggregated by a single GROUP BY once the
+        # whole chainstate is read. The staging table is temporary, it does not end up in the kept database.
+        curr.execute(
+            """
+            CREATE TEMP TABLE utxo (
+                    address BLOB NOT NULL,
+                    amount BIGINT NOT NULL,
+                    height BIGINT NOT NULL
+            )
+            """
+        )
+
+        curr.execute('BEGIN TRANSACTION')
+
+        curr.executemany(
+            """
+            INSERT INTO utxo (address, amount, height) VALUES (?, ?, ?)
+            """,
+            ((sqlite3.Binary(key), val, height) for key, val, height in add_iter)
+        )
+
+        # The height is the one of the last output read for the address (the bare column takes the value of the row
+        # with MAX(rowid)), same as in the in memory aggregation. The addresses are encoded when written, they are only
+        # stored in the kept database.
+        if path:
+            conn.create_function('encode_address', 1, lambda key: encode_address_key(bytes(key)))
+        else:
+            conn.create_function('encode_address', 1, lambda key: None)
+        curr.execute(
+            """
+            INSERT INTO balance (address, amount, height, address_key)
+            SELECT encode_address(address), amount, height, address
+            FROM (
+                SELECT address, SUM(amount) AS amount, height, MAX(rowid)
+                FROM utxo
+                GROUP BY address
+                HAVING SUM(amount) >= ?
+            )
+            """,
+            (max(min_balance, 1),)
+        )
+
+        curr.execute('DROP TABLE utxo')
+
+        if sort not in (None, 'ASC', 'DESC'):
+            raise Exception
+        if top is not None:
+            # sqlite keeps the top rows of an ORDER BY ... LIMIT in a bounded sorter
+            exp = 'SELECT address_key, amount, height FROM balance ORDER BY amount DESC LIMIT %d' % top
+            if sort == 'ASC':
+                exp = 'SELECT * FROM (%s) ORDER BY amount ASC' % exp
+        elif sort is None:
+            exp = 'SELECT address_key, amount, height FROM balance'
+        else:
+            exp = 'SELECT address_key, amount, height FROM balance ORDER BY amount %s' % sort
+
+        curr.execute(exp)
+
+        for j in curr:
+            yield bytes(j[0]), j[1], j[2]
+
+        conn.commit()
+        curr.close()
+
+    if not path:
+        os.remove(dbfile)
+
+
+BACKENDS = {
+    'memory': memory_backend,
+    'extsort': extsort_backend,
+    'sqlite': sqlite_backend,
+}
+
+
+def aggregate_balances(reader, types=ADDRESS_TYPES, backend='memory', stats=None, keys=None, **options):
+    """ Aggregates the outputs of the chainstate into the balances of the funded addresses.
+
+    :param reader: The chainstate, or the path to the chainstate directory (Bitcoin Core 0.15 onwards).
+    :type reader: ChainstateReader
+    :param types: Script types to be included, see ChainstateReader.iter_outputs.
+    :type types: iterable
+    :param backend: One of BACKENDS, or a function taking the (address key, amount, height) outputs and the options,
+        and returning the (address key, amount, height) per address.
+    :type backend: str
+    :param stats: Stats (see stats.Stats) the counters of the scan are added to.
+    :type stats: Stats
+    :param keys: Address keys the outputs are restricted to (see utils.load_watchlist), all by default.
+    :type keys: frozenset
+    :param options: Options of the backend (e.g. sort, top, min_balance, mem_budget for extsort, path for sqlite).
+    :return: Generator of (address key, amount, height) of the funded addresses.
+    :rtype: generator
+    """
+
+    if not isinstance(reader, ChainstateReader):
+        reader = ChainstateReader(reader)
+    if not callable(backend):
+        if backend not in BACKENDS:
+            raise Exception('unknown aggregation backend %s' % backend)
+        backend = BACKENDS[backend]
+
+    for key, val, height in backend(reader.iter_outputs(types, stats=stats, keys=keys), **options):
+        if val != 0:
+            yield key, val, height
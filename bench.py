@@ -0,0 +1,487 @@
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import traceback
+from binascii import hexlify
+from multiprocessing import Process, Queue
+from queue import Empty
+import plyvel
+import utils
+import btcposbal2csv
+from output import write_output
+from pipeline import parse_ldb_pipelined
+from stats import Stats, peak_rss_mb
+
+# Benchmark of the hot paths of utils.py and of the aggregation modes of btcposbal2csv.py over a synthetic chainstate.
+# Every stage runs in its own process, so that the peak RSS reported is the one of the stage.
+
+# Share of the coins per script type of the synthetic chainstate, roughly the mix of the mainnet UTXO set
+SCRIPT_MIX = (
+    ('p2pkh', 0.40),
+    ('p2sh', 0.20),
+    ('p2pk', 0.02),
+    ('p2wpkh', 0.25),
+    ('p2wsh', 0.04),
+    ('p2tr', 0.06),
+    ('op_return', 0.03),
+)
+
+# Decoder processes of the pipelined stages
+PIPELINE_WORKERS = 2
+
+# Seconds between the checks that the process of a stage is still running
+STAGE_POLL = 1.0
+
+
+def b128_encode(n):
+    """ Encodes a value as a MSB base-128 varint, the inverse of utils.read_b128.
+    """
+
+    out = bytearray([n & 0x7F])
+    n >>= 7
+    while n:
+        n -= 1
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.reverse()
+    return out
+
+
+def txout_compress(n):
+    """ Compresses an amount of satoshi, the inverse of utils.txout_decompress.
+    """
+
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    return 1 + (n - 1) * 10 + 9
+
+
+def random_bytes(rnd, size):
+    return bytearray(rnd.getrandbits(8) for _ in range(size))
+
+
+def random_script(rnd, kind, hashes, programs):
+    """ Gets the compressed script type and the script of a coin of the given kind. Hashes and witness programs are
+    taken from the given pools, so that addresses are reused.
+    """
+
+    if kind == 'p2pkh':
+        return 0, rnd.choice(hashes)
+    elif kind == 'p2sh':
+        return 1, rnd.choice(hashes)
+    elif kind == 'p2pk':
+        out_type = rnd.randint(2, 5)
+        return out_type, bytearray([out_type]) + random_bytes(rnd, 32)
+    elif kind == 'p2wpkh':
+        script = bytearray([0x00, 20]) + rnd.choice(hashes)
+    elif kind == 'p2wsh':
+        script = bytearray([0x00, 32]) + rnd.choice(programs)
+    elif kind == 'p2tr':
+        script = bytearray([0x51, 32]) + rnd.choice(programs)
+    else:
+        script = bytearray([0x6a, 8]) + random_bytes(rnd, 8)
+    return len(script) + utils.NSPECIALSCRIPTS, script
+
+
+def random_coin(rnd, hashes, programs):
+    """ Gets a random coin as (height, coinbase, amount, out_type, script).
+    """
+
+    r = rnd.random()
+    for kind, share in SCRIPT_MIX:
+        r -= share
+        if r < 0:
+            break
+    out_type, script = random_script(rnd, kind, hashes, programs)
+    amount = 0 if kind == 'op_return' else rnd.choice((546, 10 ** rnd.randint(3, 9), rnd.randint(1, 10 ** 10)))
+    return rnd.randint(1, 800000), int(rnd.random() < 0.01), amount, out_type, script
+
+
+def serialize_coin(height, coinbase, amount, out_type, script):
+    """ Serializes a coin in the chainstate format of Bitcoin Core 0.15 onwards.
+    """
+
+    if out_type in (2, 3, 4, 5):
+        # The type byte of the compressed public key is the script type itself
+        script = script[1:]
+    return b128_encode(2 * height + coinbase) + b128_encode(txout_compress(amount)) + b128_encode(out_type) + script
+
+
+def serialize_utxo_v08_v014(height, coinbase, amount, out_type, script):
+    """ Serializes a coin as a single output transaction in the chainstate format of Bitcoin Core 0.08 - 0.14.
+    """
+
+    if out_type in (2, 3, 4, 5):
+        script = script[1:]
+    return (b128_encode(1) + b128_encode(0x02 | coinbase) + b128_encode(txout_compress(amount)) +
+            b128_encode(out_type) + script + b128_encode(height))
+
+
+def make_chainstate(path, coins, reuse=0.5, seed=1):
+    """ Creates a synthetic, obfuscated chainstate LevelDB (Bitcoin Core 0.15 onwards format).
+
+    :param path: Path to the (non-existing) chainstate directory.
+    :type path: str
+    :param coins: Number of coins.
+    :type coins: int
+    :param reuse: Share of the coins paying to an address already used by another coin.
+    :type reuse: float
+    :param seed: Seed of the random generator.
+    :type seed: int
+    """
+
+    rnd = random.Random(seed)
+    pool_size = max(1, int(coins * (1 - reuse)))
+    hashes = [random_bytes(rnd, 20) for _ in range(pool_size)]
+    programs = [random_bytes(rnd, 32) for _ in range(max(1, pool_size // 10))]
+
+    o_key = random_bytes(rnd, 8)
+    deobfuscate = utils.deobfuscator(bytes(o_key))
+
+    db = plyvel.DB(path, create_if_missing=True, error_if_exists=True)
+    try:
+        db.put(b'\x0e\x00obfuscate_key', bytes(bytearray([len(o_key)]) + o_key))
+        batch = db.write_batch()
+        for i in range(coins):
+            outpoint = b'C' + bytes(random_bytes(rnd, 32) + b128_encode(rnd.randint(0, 3)))
+            # XOR with the key stream is its own inverse
+            batch.put(outpoint, bytes(deobfuscate(bytes(serialize_coin(*random_coin(rnd, hashes, programs))))))
+            if i % 100000 == 99999:
+                batch.write()
+                batch = db.write_batch()
+        batch.write()
+        db.put(b'B', bytes(random_bytes(rnd, 32)))
+    finally:
+        db.close()
+
+
+def load_values(path, limit):
+    db = plyvel.DB(path)
+    try:
+        o_key = db.get(b'\x0e\x00obfuscate_key')
+        values = []
+        for key, value in db.iterator(prefix=b'C'):
+            values.append((key, value))
+            if len(values) == limit:
+                break
+        return o_key, values
+    finally:
+        db.close()
+
+
+def mode_args(chainstate, **kwargs):
+    args = argparse.Namespace(
+        chainstate=chainstate, bitcoin_version=0.15, P2PKH=True, P2SH=True, P2W=True, P2PK=False, jobs=1,
+        keep_sqlite=None, sort=None, extsort_mem=1024, incremental=None, watchlist=None, top=None,
+        min_balance=1, pipeline=0, scratch=None, cache_mb=None, fill_cache=False, max_open_files=4096, block_size=None,
+        readahead=False)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def stage_iterate(chainstate, limit):
+    db = plyvel.DB(chainstate)
+    try:
+        return sum(1 for _ in db.iterator(prefix=b'C', include_key=False))
+    finally:
+        db.close()
+
+
+def stage_deobfuscate_value(chainstate, limit):
+    o_key, values = load_values(chainstate, limit)
+    o_key = hexlify(o_key)[2:]
+    values = [hexlify(value) for _, value in values]
+    start = time.time()
+    for value in values:
+        utils.deobfuscate_value(o_key, value)
+    return len(values), time.time() - start
+
+
+def stage_deobfuscator(chainstate, limit):
+    o_key, values = load_values(chainstate, limit)
+    deobfuscate = utils.deobfuscator(o_key[1:])
+    start = time.time()
+    for _, value in values:
+        deobfuscate(value)
+    return len(values), time.time() - start
+
+
+def stage_decode_utxo(chainstate, limit):
+    o_key, values = load_values(chainstate, limit)
+    deobfuscate = utils.deobfuscator(o_key[1:])
+    values = [(hexlify(bytes(deobfuscate(value))), hexlify(key)) for key, value in values]
+    start = time.time()
+    for value, key in values:
+        utils.decode_utxo(value, key)
+    return len(values), time.time() - start
+
+
+def time_decode_coin(chainstate, limit, decode_coin):
+    o_key, values = load_values(chainstate, limit)
+    deobfuscate = utils.deobfuscator(o_key[1:])
+    values = [deobfuscate(value) for _, value in values]
+    start = time.time()
+    for value in values:
+        decode_coin(value)
+    seconds = time.time() - start
+    # The compiled decoder (when built) must give the same coins as the pure Python one
+    for value in values:
+        assert decode_coin(value) == utils.py_decode_coin(value)
+    return len(values), seconds
+
+
+def stage_decode_coin(chainstate, limit):
+    return time_decode_coin(chainstate, limit, utils.decode_coin)
+
+
+def stage_decode_coin_py(chainstate, limit):
+    return time_decode_coin(chainstate, limit, utils.py_decode_coin)
+
+
+def legacy_values(limit):
+    rnd = random.Random(2)
+    hashes = [random_bytes(rnd, 20) for _ in range(max(1, limit // 2))]
+    programs = [random_bytes(rnd, 32) for _ in range(max(1, limit // 20))]
+    return [serialize_utxo_v08_v014(*random_coin(rnd, hashes, programs)) for _ in range(limit)]
+
+
+def stage_decode_utxo_v08_v014(chainstate, limit):
+    values = [hexlify(bytes(value)) for value in legacy_values(limit)]
+    start = time.time()
+    for value in values:
+        utils.decode_utxo_v08_v014(value)
+    return len(values), time.time() - start
+
+
+def stage_decode_coin_v08_v014(chainstate, limit):
+    values = legacy_values(limit)
+    start = time.time()
+    for value in values:
+        utils.decode_coin_v08_v014(value)
+    return len(values), time.time() - start
+
+
+def address_keys(chainstate, limit):
+    return [key for key, _, _ in utils.parse_ldb(chainstate, types=(0, 1), not_decoded=[0, 0])][:limit]
+
+
+def stage_hash_160_to_btc_address(chainstate, limit):
+    keys = [(key[1:], bytearray(key[:1])[0]) for key in address_keys(chainstate, limit)]
+    start = time.time()
+    for h160, v in keys:
+        utils.hash_160_to_btc_address(h160, v)
+    return len(keys), time.time() - start
+
+
+def stage_encode_address_key(chainstate, limit):
+    keys = address_keys(chainstate, limit)
+    start = time.time()
+    for key in keys:
+        utils.encode_address_key(key)
+    return len(keys), time.time() - start
+
+
+def stage_parse_ldb(chainstate, limit):
+    return sum(1 for _ in utils.parse_ldb(chainstate, types=(0, 1, 2, 3, 4, 5, utils.WITNESS), not_decoded=[0, 0]))
+
+
+def stage_parse_ldb_pipelined(chainstate, limit):
+    return sum(1 for _ in parse_ldb_pipelined(
+        chainstate, types=(0, 1, 2, 3, 4, 5, utils.WITNESS), workers=PIPELINE_WORKERS, not_decoded=[0, 0]))
+
+
+def run_mode(mode, args):
+    fd, out = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        # The progress would be written in the middle of the report
+        return write_output(mode(args, Stats(progress=False)), out)
+    finally:
+        os.remove(out)
+
+
+def stage_in_mem(chainstate, limit):
+    return run_mode(btcposbal2csv.in_mem, mode_args(chainstate))
+
+
+def stage_in_mem_pipelined(chainstate, limit):
+    return run_mode(btcposbal2csv.in_mem, mode_args(chainstate, pipeline=PIPELINE_WORKERS))
+
+
+def stage_low_mem(chainstate, limit):
+    return run_mode(btcposbal2csv.low_mem, mode_args(chainstate))
+
+
+def stage_ext_mem(chainstate, limit):
+    return run_mode(btcposbal2csv.ext_mem, mode_args(chainstate, extsort_mem=64))
+
+
+def stage_incremental(chainstate, limit):
+    snapshot = tempfile.mkdtemp()
+    try:
+        return run_mode(btcposbal2csv.incremental, mode_args(chainstate, incremental=os.path.join(snapshot, 'snap')))
+    finally:
+        shutil.rmtree(snapshot)
+
+
+# (name, function): functions return either the number of records, timed as a whole, or (records, seconds) when only
+# part of the stage is timed (the records are loaded in memory first).
+STAGES = (
+    ('iterate', stage_iterate),
+    ('deobfuscate_value', stage_deobfuscate_value),
+    ('deobfuscator', stage_deobfuscator),
+    ('decode_utxo', stage_decode_utxo),
+    ('decode_coin', stage_decode_coin),
+    ('decode_coin_py', stage_decode_coin_py),
+    ('decode_utxo_v08_v014', stage_decode_utxo_v08_v014),
+    ('decode_coin_v08_v014', stage_decode_coin_v08_v014),
+    ('hash_160_to_btc_address', stage_hash_160_to_btc_address),
+    ('encode_address_key', stage_encode_address_key),
+    ('parse_ldb', stage_parse_ldb),
+    ('parse_ldb_pipelined', stage_parse_ldb_pipelined),
+    ('in_mem', stage_in_mem),
+    ('in_mem_pipelined', stage_in_mem_pipelined),
+    ('low_mem', stage_low_mem),
+    ('ext_mem', stage_ext_mem),
+    ('incremental', stage_incremental),
+)
+
+
+def run_stage(function, chainstate, limit, queue):
+    # Messages of the scan are not part of the report
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        result = function(chainstate, limit)
+        if isinstance(result, tuple):
+            records, seconds = result
+        else:
+            records, seconds = result, time.time() - start
+        queue.put(('done', (records, seconds, peak_rss_mb())))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+
+def wait_stage(p, queue):
+    """ Waits for the result of the process of a stage (see run_stage), or its exit without a result.
+    """
+
+    while True:
+        try:
+            return queue.get(timeout=STAGE_POLL)
+        except Empty:
+            if p.exitcode is not None:
+                # The result may have been sent right before the exit
+                try:
+                    return queue.get(timeout=STAGE_POLL)
+                except Empty:
+                    return 'error', 'stage process exited with code %d\n' % p.exitcode
+
+
+def benchmark(chainstate, stages, limit):
+    """ Runs the stages and prints their report, the tracebacks of the failed stages go to stderr.
+
+    :return: The names of the failed stages.
+    :rtype: list
+    """
+
+    failed = []
+    print('%-24s %10s %10s %12s %12s' % ('stage', 'records', 'seconds', 'records/s', 'peak RSS MB'))
+    for name, function in STAGES:
+        if stages and name not in stages:
+            continue
+        queue = Queue()
+        p = Process(target=run_stage, args=(function, chainstate, limit, queue))
+        p.start()
+        kind, result = wait_stage(p, queue)
+        p.join()
+        if kind == 'error':
+            print('%-24s failed' % name)
+            sys.stderr.write(result)
+            failed.append(name)
+            continue
+        records, seconds, rss = result
+        print('%-24s %10d %10.3f %12.0f %12.1f' % (name, records, seconds, records / max(seconds, 1e-9), rss))
+    return failed
+
+
+def input_args():
+    parser = argparse.ArgumentParser(description='Benchmark the chainstate decoding and the address aggregation over a'
+                                                 ' synthetic chainstate')
+    parser.add_argument(
+        '--coins',
+        metavar='N',
+        type=int,
+        default=200000,
+        help='number of coins of the synthetic chainstate, default 200000'
+    )
+    parser.add_argument(
+        '--reuse',
+        metavar='SHARE',
+        type=float,
+        default=0.5,
+        help='share of the coins paying to an already used address, default 0.5'
+    )
+    parser.add_argument(
+        '--limit',
+        metavar='N',
+        type=int,
+        default=50000,
+        help='number of records of the single function stages, default 50000'
+    )
+    parser.add_argument(
+        '--chainstate',
+        metavar='PATH_TO_CHAINSTATE_DIR',
+        type=str,
+        default=None,
+        help='use (or create if it does not exist) this synthetic chainstate instead of a temporary one'
+    )
+    parser.add_argument(
+        '--stages',
+        metavar='STAGE',
+        nargs='+',
+        choices=[name for name, _ in STAGES],
+        default=None,
+        help='stages to run, default all'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = input_args()
+
+    tmpdir = None
+    chainstate = args.chainstate
+    if chainstate is None:
+        tmpdir = tempfile.mkdtemp()
+        chainstate = os.path.join(tmpdir, 'chainstate')
+    try:
+        if not os.path.exists(chainstate):
+            print('creating synthetic chainstate with %d coins in %s' % (args.coins, chainstate))
+            # LevelDB is not opened in this process: the stage processes are forked from it and would inherit its state
+            # without its background compaction thread, waiting forever for the compactions of their writes.
+            p = Process(target=make_chainstate, args=(chainstate, args.coins, args.reuse))
+            p.start()
+            p.join()
+            if p.exitcode:
+                sys.exit('unable to create the synthetic chainstate')
+        failed = benchmark(chainstate, args.stages, args.limit)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    if failed:
+        sys.exit('failed stages: %s' % ', '.join(failed))
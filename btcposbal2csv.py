@@ -1,13 +1,23 @@
 import os
+import sys
+import signal
+import shutil
 import tempfile
 import argparse
-import sqlite3
-from utils import parse_ldb
+from hashlib import sha256
+from utils import parse_ldb, clone_live_chainstate, read_best_block, load_watchlist, SCAN_TUNING, WITNESS
+from chainstate import ChainstateReader
+from pipeline import parse_ldb_pipelined
+from aggregation import aggregate, aggregate_parallel, select_balances, sqlite_backend, extsort_backend
+from snapshot import update_snapshot, iter_balances
+from output import (OUT_FORMATS, OUT_FORMAT_PACKAGES, ADDRESS_FORMATS, guess_out_format, missing_package,
+                    write_output, read_meta, write_meta, clear_meta)
+from stats import Stats
 
 
 def input_args():
     parser = argparse.ArgumentParser(description='Process UTXO set from chainstate and return unspent output per'
-                                                 ' address for P2PKH and P2SH addresses')
+                                                 ' address for P2PKH, P2SH and SegWit/Taproot addresses')
     parser.add_argument(
         'chainstate',
         metavar='PATH_TO_CHAINSTATE_DIR',
@@ -25,7 +35,23 @@ def input_args():
         metavar='OUTFILE',
         type=str,
         default=None,
-        help='output file in .csv'
+        help='output file in .csv, - for stdout; a directory for npy output'
+    )
+    parser.add_argument(
+        '--out_format',
+        choices=OUT_FORMATS,
+        default=None,
+        help='format of the output file, by default given by the extension of OUTFILE, csv otherwise; '
+             'npy (a directory of NumPy arrays) and parquet (needs pyarrow) hold the address type and hash in binary, '
+             'index is a directory with the addresses sorted for lookups (see index.py)'
+    )
+    parser.add_argument(
+        '--address_format',
+        choices=ADDRESS_FORMATS,
+        default='address',
+        help='address columns of the csv output: address (default), ripemd (script type and hex hash160/witness '
+             'program instead of the address, no address encoding is done) or both (address and hex hash, same '
+             'columns as the output of convert2ripemd160)'
     )
     parser.add_argument(
         '--keep_sqlite',
@@ -39,6 +65,116 @@ def input_args():
         action='store_true',
         help='use sqlite for aggregation of addresses instead of doing it in memory'
     )
+    parser.add_argument(
+        '--extsort',
+        action='store_true',
+        help='aggregate addresses by sorting and merging temporary files on disk instead of doing it in memory'
+    )
+    parser.add_argument(
+        '--extsort_mem',
+        metavar='MB',
+        type=int,
+        default=1024,
+        help='memory used by --extsort before spilling to disk, default 1024'
+    )
+    parser.add_argument(
+        '--incremental',
+        metavar='PATH_TO_SNAPSHOT_DIR',
+        type=str,
+        default=None,
+        help='keep a snapshot of the coins and balances in this directory and only apply the coins created and '
+             'spent since the previous run, the first run builds the snapshot; '
+             'last_height of an address is then the height of the last coin it received since the snapshot was made'
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='number of worker processes scanning the chainstate in parallel, default 1; '
+             'each worker reads its own hard-linked copy of the chainstate (made in --scratch)'
+    )
+    parser.add_argument(
+        '--scratch',
+        metavar='PATH_TO_SCRATCH_DIR',
+        type=str,
+        default=None,
+        help='directory of the copies of the chainstate read by the --jobs workers, removed at the end; it should be '
+             'on the same filesystem as the chainstate so that the table files are hard-linked (they are copied '
+             'otherwise), default the --live directory or the system temporary directory'
+    )
+    parser.add_argument(
+        '--pipeline',
+        metavar='N',
+        type=int,
+        default=0,
+        help='read the chainstate in a separate process and decode it in N worker processes, the aggregation '
+             'overlapping with both; the result is the same as a serial scan, default 0 (serial scan)'
+    )
+    parser.add_argument(
+        '--cache_mb',
+        metavar='MB',
+        type=int,
+        default=None,
+        help='size of the LevelDB block cache, default 8'
+    )
+    parser.add_argument(
+        '--fill_cache',
+        action='store_true',
+        help='keep the blocks read in the LevelDB block cache, they are not by default as every block is read once'
+    )
+    parser.add_argument(
+        '--max_open_files',
+        metavar='N',
+        type=int,
+        default=SCAN_TUNING['max_open_files'],
+        help='number of table files LevelDB keeps open, default %d (capped by the open files limit)'
+             % SCAN_TUNING['max_open_files']
+    )
+    parser.add_argument(
+        '--block_size',
+        metavar='BYTES',
+        type=int,
+        default=None,
+        help='block size of the LevelDB tables written when the chainstate is opened (recovery, compactions), '
+             'default 4096'
+    )
+    parser.add_argument(
+        '--readahead',
+        action='store_true',
+        help='load the chainstate table files in the page cache in the background while they are scanned, for spinning '
+             'disks and network volumes when the chainstate fits in memory'
+    )
+    parser.add_argument(
+        '--live',
+        metavar='PATH_TO_SCRATCH_DIR',
+        type=str,
+        default=None,
+        help='the node is running: scan a point-in-time copy of the chainstate made in this directory, which should be '
+             'on the same filesystem as the chainstate (the table files are hard-linked), and removed at the end'
+    )
+    parser.add_argument(
+        '--watchlist',
+        metavar='PATH_TO_ADDRESS_FILE',
+        type=str,
+        default=None,
+        help='only output the balances of the addresses of this file (one per line, or in the first column of a csv); '
+             'the other outputs are dropped as soon as they are decoded'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='scan the chainstate even if OUTFILE is up to date with its best block (see OUTFILE.meta.json)'
+    )
+    parser.add_argument(
+        '--stats_json',
+        metavar='PATH_TO_JSON_FILE',
+        type=str,
+        default=None,
+        help='time the stages of the run (reading, de-obfuscation, decoding, aggregation, address encoding, output) '
+             'and write them with the counters, rates and peak memory to this json file; the timing slows the scan a '
+             'little'
+    )
     parser.add_argument(
         '--P2PKH',
         metavar='bool',
@@ -53,6 +189,13 @@ def input_args():
         default=True,
         help='include P2PSH transactions, default 1'
     )
+    parser.add_argument(
+        '--P2W',
+        metavar='bool',
+        type=bool,
+        default=True,
+        help='include SegWit (P2WPKH, P2WSH) and Taproot (P2TR) transactions, default 1'
+    )
     parser.add_argument(
         '--P2PK',
         metavar='bool',
@@ -71,6 +214,20 @@ def input_args():
              'ASCending / DESCending '
              'if not given not sorting will be done'
     )
+    parser.add_argument(
+        '--top',
+        metavar='N',
+        type=int,
+        default=None,
+        help='only output the N addresses with the highest balances, by descending amount unless --sort ASC is given'
+    )
+    parser.add_argument(
+        '--min_balance',
+        metavar='SAT',
+        type=int,
+        default=1,
+        help='only output the addresses with at least SAT satoshi, default 1'
+    )
     a = parser.parse_args()
 
     if a.sort not in {None, 'ASC', 'DESC'}:
@@ -78,6 +235,38 @@ def input_args():
 
     if a.keep_sqlite and not a.lowmem:
         raise AssertionError('--keep_sqlite cannot be used with --lowmem')
+
+    if a.jobs < 1:
+        raise AssertionError('--jobs must be at least 1')
+
+    if a.pipeline < 0:
+        raise AssertionError('--pipeline cannot be negative')
+
+    if a.max_open_files < 16:
+        raise AssertionError('--max_open_files must be at least 16')
+
+    if a.top is not None and a.top < 1:
+        raise AssertionError('--top must be at least 1')
+
+    if a.jobs > 1 and a.lowmem:
+        raise AssertionError('--jobs cannot be used with --lowmem')
+
+    if a.extsort and a.lowmem:
+        raise AssertionError('--extsort cannot be used with --lowmem')
+
+    if a.jobs > 1 and a.extsort:
+        raise AssertionError('--jobs cannot be used with --extsort')
+
+    if a.pipeline and a.jobs > 1:
+        raise AssertionError('--pipeline cannot be used with --jobs')
+
+    if a.incremental and (a.lowmem or a.extsort or a.jobs > 1 or a.pipeline):
+        raise AssertionError('--incremental cannot be used with --lowmem, --extsort, --jobs or --pipeline')
+
+    # Checked before the chainstate is scanned and the output file is created
+    out_format = a.out_format or guess_out_format(a.out)
+    if missing_package(out_format) is not None:
+        raise AssertionError('%s output needs the %s package' % (out_format, OUT_FORMAT_PACKAGES[out_format]))
     return a
 
 
@@ -87,129 +276,202 @@ def get_types(in_args):
         keep_types.add(0)
     if in_args.P2SH:
         keep_types.add(1)
+    if in_args.P2W:
+        keep_types.add(WITNESS)
     if in_args.P2PK:
         keep_types |= {2, 3, 4, 5}
     return keep_types
 
 
-def in_mem(in_args):
+def get_keys(in_args):
+    if not in_args.watchlist:
+        return None
+    keys, ignored = load_watchlist(in_args.watchlist)
+    print('watchlist: %d addresses, %d lines ignored' % (len(keys), ignored))
+    return keys
+
+
+def get_tuning(in_args):
+    return {
+        'fill_cache': in_args.fill_cache,
+        'lru_cache_size': in_args.cache_mb and in_args.cache_mb * 1024 * 1024,
+        'block_size': in_args.block_size,
+        'max_open_files': in_args.max_open_files,
+        'readahead': in_args.readahead,
+    }
+
+
+def watchlist_meta(path):
+    """ Identifies a watchlist by its path and the hash of its content, the modification time does not tell two files
+    (or two versions of a file within the timestamp resolution) apart.
+    """
+
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return {'path': os.path.abspath(path), 'sha256': digest.hexdigest()}
+
+
+def run_meta(in_args, out_format, best_block):
+    """ Gets the metadata of the output: the best block of the chainstate, and the options the output depends on. An
+    existing output with the same metadata is up to date.
+    """
 
-    add_dict = dict()
-    for add, val, height in parse_ldb(
+    return {
+        'best_block': best_block,
+        'types': sorted(get_types(in_args)),
+        'out_format': out_format,
+        'address_format': in_args.address_format,
+        'sort': in_args.sort,
+        'top': in_args.top,
+        'min_balance': in_args.min_balance,
+        'keep_sqlite': in_args.keep_sqlite,
+        'watchlist': in_args.watchlist and watchlist_meta(in_args.watchlist),
+        # The last heights of an incremental output are the ones of the coins added since the snapshot was made
+        'incremental': in_args.incremental and os.path.abspath(in_args.incremental),
+    }
+
+
+def scan(in_args, stats):
+    """ Iterates over the outputs of the chainstate, serially or with the --pipeline processes.
+    """
+
+    if in_args.pipeline:
+        return parse_ldb_pipelined(
             fin_name=in_args.chainstate,
             version=in_args.bitcoin_version,
-            types=get_types(in_args)):
-        if add in add_dict:
-            add_dict[add][0] += val
-            add_dict[add][1] = height
-        else:
-            add_dict[add] = [val, height]
+            types=get_types(in_args),
+            workers=in_args.pipeline,
+            stats=stats,
+            keys=get_keys(in_args),
+            tuning=get_tuning(in_args))
+    return parse_ldb(
+        fin_name=in_args.chainstate,
+        version=in_args.bitcoin_version,
+        types=get_types(in_args),
+        stats=stats,
+        keys=get_keys(in_args),
+        tuning=get_tuning(in_args))
 
-    for key in add_dict.iterkeys():
-        ll = add_dict[key]
-        yield key, ll[0], ll[1]
 
+def in_mem_parallel(in_args, stats):
+    def progress(done, total):
+        print(' scanned key ranges: %d/%d' % (done, total))
 
-def low_mem(in_args):
-    keep_types = []
-    if in_args.P2PKH:
-        keep_types.append(0)
-    if in_args.P2SH:
-        keep_types.append(1)
-    if in_args.P2PK:
-        keep_types += [2, 3, 4, 5]
+    reader = ChainstateReader(in_args.chainstate, in_args.bitcoin_version, get_tuning(in_args))
+    balances = aggregate_parallel(reader, get_types(in_args), in_args.jobs, stats, progress, get_keys(in_args),
+                                  in_args.scratch or in_args.live)
 
-    if in_args.keep_sqlite:
-        dbfile = in_args.keep_sqlite
+    print('unable to decode %d transactions' % stats.counters.get('not_decoded', 0))
+    print('totaling %d satoshi' % stats.counters.get('not_decoded_satoshi', 0))
+    return balances
+
+
+def in_mem(in_args, stats=None):
+    if stats is None:
+        stats = Stats()
+
+    if in_args.jobs > 1:
+        balances = in_mem_parallel(in_args, stats)
     else:
-        fd, dbfile = tempfile.mkstemp()
-        os.close(fd)
-
-    with sqlite3.connect(dbfile) as conn:
-        curr = conn.cursor()
-
-        curr.execute(
-            """
-            DROP TABLE IF EXISTS balance
-            """
-        )
-
-        curr.execute(
-            """
-            CREATE TABLE balance (
-                    address TEXT PRIMARY KEY,
-                    amount BIGINT NOT NULL,
-                    height BIGINT NOT NULL
-            )
-            """
-        )
-
-        curr.execute('BEGIN TRANSACTION')
-
-        expinsert = """
-            INSERT OR IGNORE INTO balance (address, amount, height) VALUES (?, ?, ?)"""
-        expupdate = """
-            UPDATE balance SET
-            amount = amount + ?,
-            height = ?
-            WHERE address = ?
-            """
-        for add, val, height in parse_ldb(
-                fin_name=in_args.chainstate,
-                version=in_args.bitcoin_version,
-                types=get_types(in_args)):
-            curr.execute(expinsert, (add, 0, 0))
-            curr.execute(expupdate, (val, height, add))
-
-        if in_args.sort is None:
-            exp = 'SELECT * FROM balance'
-        elif in_args.sort == 'ASC':
-            exp = 'SELECT * FROM balance ORDER BY amount ASC'
-        elif in_args.sort == 'DESC':
-            exp = 'SELECT * FROM balance ORDER BY amount DESC'
-        else:
-            raise Exception
+        balances = aggregate(scan(in_args, stats))
+
+    return balances.select(in_args.top, in_args.min_balance, in_args.sort)
+
 
-        curr.execute(exp)
+def low_mem(in_args, stats=None):
+    return sqlite_backend(
+        scan(in_args, stats),
+        path=in_args.keep_sqlite,
+        sort=in_args.sort,
+        top=in_args.top,
+        min_balance=in_args.min_balance)
 
-        for j in curr:
-            yield j[0], j[1], j[2]
 
-        conn.commit()
-        curr.close()
+def ext_mem(in_args, stats=None):
+    add_iter = extsort_backend(
+        scan(in_args, stats),
+        mem_budget=in_args.extsort_mem * 1024 * 1024,
+        sort=in_args.sort,
+        top=in_args.top,
+        min_balance=in_args.min_balance)
 
-    if not in_args.keep_sqlite:
-        os.remove(dbfile)
+    return ((key, val, height) for key, val, height in add_iter if val != 0)
+
+
+def incremental(in_args, stats=None):
+    update_snapshot(
+        fin_name=in_args.chainstate,
+        snapshot=in_args.incremental,
+        version=in_args.bitcoin_version,
+        types=get_types(in_args),
+        stats=stats,
+        tuning=get_tuning(in_args))
+
+    # The snapshot holds all the addresses, the watchlist only filters its balances
+    keys = get_keys(in_args)
+    add_iter = iter_balances(in_args.incremental)
+    if keys is not None:
+        add_iter = (record for record in add_iter if record[0] in keys)
+    return select_balances(add_iter, in_args.top, in_args.min_balance, in_args.sort)
 
 
 if __name__ == '__main__':
 
     args = input_args()
 
-    print('reading chainstate database')
-    if args.lowmem:
-        print('lowmem')
-        add_iter = low_mem(args)
-    else:
-        print('inmem')
-        add_iter = in_mem(args)
-
-    if args.out:
-        w = ['address,value_satoshi,last_height']
-        with open(args.out, 'w') as f:
-            c = 0
-            for address, sat_val, block_height in add_iter:
-                if sat_val == 0:
-                    continue
-                w.append(
-                    address + ',' + str(sat_val) + ',' + str(block_height)
-                )
-                c += 1
-                if c == 1000:
-                    f.write('\n'.join(w) + '\n')
-                    w = []
-                    c = 0
-            if c > 0:
-                f.write('\n'.join(w) + '\n')
-            f.write('\n')
-        print('writen to %s' % args.out)
+    if args.out == '-':
+        # The output goes to stdout, the messages to stderr
+        sys.stdout = sys.stderr
+
+    stats = Stats(timed=args.stats_json is not None)
+
+    # The copies of the chainstate are removed when the run is terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    scratch = None
+    try:
+        if args.live:
+            print('copying chainstate')
+            scratch = tempfile.mkdtemp(dir=args.live)
+            args.chainstate = clone_live_chainstate(args.chainstate, os.path.join(scratch, 'chainstate'))
+
+        out_format = args.out_format or guess_out_format(args.out)
+        meta = run_meta(args, out_format, read_best_block(args.chainstate))
+        print('best block %s' % meta['best_block'])
+
+        previous = read_meta(args.out) if args.out != '-' and not args.force else None
+        if meta['best_block'] is not None and previous is not None and all(
+                previous.get(name) == value for name, value in meta.items()):
+            print('%s is up to date' % args.out)
+        else:
+            print('reading chainstate database')
+            if args.lowmem:
+                print('lowmem')
+                add_iter = low_mem(args, stats)
+            elif args.extsort:
+                print('extsort')
+                add_iter = ext_mem(args, stats)
+            elif args.incremental:
+                print('incremental')
+                add_iter = incremental(args, stats)
+            else:
+                print('inmem')
+                add_iter = in_mem(args, stats)
+
+            if args.out != '-':
+                clear_meta(args.out)
+            count = write_output(add_iter, args.out, out_format, args.address_format, stats, meta)
+            print('writen to %s' % args.out)
+            if args.out != '-':
+                meta['max_height'] = stats.maxima.get('max_height')
+                meta['addresses'] = count
+                write_meta(args.out, meta)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch)
+
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+        print('stats written to %s' % args.stats_json)
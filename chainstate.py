@@ -0,0 +1,110 @@
+from collections import namedtuple
+from utils import (parse_ldb, utxo_prefix, open_chainstate, chainstate_deobfuscator, decode_coin, decode_coin_v08_v014,
+                   read_b128, read_best_block, address_key, WITNESS)
+
+# Library access to the chainstate, without any output to stdout or stderr. The counters of a scan (number of outputs,
+# outputs which could not be decoded, ...) are given through a stats.Stats object instead.
+
+# Script types of the outputs with an address: P2PKH, P2SH and witness programs
+ADDRESS_TYPES = (0, 1, WITNESS)
+
+
+class Coin(namedtuple('Coin', ('outpoint', 'height', 'coinbase', 'amount', 'out_type', 'script'))):
+    """ Unspent output of the chainstate. The outpoint is the (transaction id, output index) pair, the transaction id
+    being the raw 32 bytes as stored in the chainstate (little endian). The script is the compressed script, see
+    utils.decode_utxo for the meaning of the script types.
+    """
+
+    __slots__ = ()
+
+    def address_key(self):
+        """ Gets the address key of the coin (see utils.encode_address_key), or None if it has no known address.
+        """
+
+        return address_key(self.out_type, self.script)
+
+
+class ChainstateReader(object):
+    """ Reads the UTXO set of a chainstate LevelDB. The database is opened for the duration of every iteration only, so
+    a long-running process does not keep it locked between scans.
+
+    :param path: Path to the chainstate directory.
+    :type path: str
+    :param version: Bitcoin Core version that created the chainstate LevelDB.
+    :type version: float
+    :param tuning: Read options of the scans, see utils.SCAN_TUNING.
+    :type tuning: dict
+    """
+
+    def __init__(self, path, version=0.15, tuning=None):
+        self.path = path
+        self.version = version
+        self.tuning = tuning
+        self.prefix = utxo_prefix(version)
+
+    def best_block(self):
+        """ Gets the hash of the block the chainstate is up to date with (hex), see utils.read_best_block.
+        """
+
+        return read_best_block(self.path)
+
+    def iter_coins(self, start=None, stop=None):
+        """ Iterates over the coins of the chainstate, in key order.
+
+        :param start: First key of the range to read (see utils.split_key_range), defaults to the whole UTXO set.
+        :type start: bytes
+        :param stop: Key closing the range to read (exclusive).
+        :type stop: bytes
+        :return: Generator of Coin.
+        :rtype: generator
+        """
+
+        db, read_options = open_chainstate(self.path, self.tuning)
+        try:
+            deobfuscate = chainstate_deobfuscator(db)
+            if start is None:
+                iterator = db.iterator(prefix=self.prefix, **read_options)
+            else:
+                iterator = db.iterator(start=start, stop=stop, **read_options)
+            for key, o_value in iterator:
+                value = deobfuscate(o_value)
+                if self.version < 0.15:
+                    # One entry per transaction, with all its unspent outputs
+                    height, coinbase, outs = decode_coin_v08_v014(value)
+                    tx_id = bytes(key[1:])
+                    for index, amount, out_type, script in outs:
+                        yield Coin((tx_id, index), height, coinbase, amount, out_type, script)
+                else:
+                    height, coinbase, amount, out_type, script = decode_coin(value)
+                    index, _ = read_b128(bytearray(key), 33)
+                    yield Coin((bytes(key[1:33]), index), height, coinbase, amount, out_type, script)
+        finally:
+            db.close()
+
+    def iter_outputs(self, types=ADDRESS_TYPES, start=None, stop=None, stats=None, keys=None):
+        """ Iterates over the outputs of the given script types as (address key, amount, height), see utils.parse_ldb.
+
+        :param types: Script types to be included, WITNESS standing for all the witness programs.
+        :type types: iterable
+        :param start: First key of the range to read, defaults to the whole UTXO set.
+        :type start: bytes
+        :param stop: Key closing the range to read (exclusive).
+        :type stop: bytes
+        :param stats: Stats (see stats.Stats) the counters of the scan are added to.
+        :type stats: Stats
+        :param keys: Address keys the outputs are restricted to (see utils.load_watchlist), all by default.
+        :type keys: frozenset
+        :return: Generator of (address key, amount, height).
+        :rtype: generator
+        """
+
+        return parse_ldb(
+            fin_name=self.path,
+            version=self.version,
+            types=types,
+            start=start,
+            stop=stop,
+            not_decoded=[0, 0],
+            stats=stats,
+            keys=keys,
+            tuning=self.tuning)
@@ -1,29 +1,105 @@
+import sys
 import base58
 import binascii
 import argparse
 import bech32
+from itertools import islice
+from multiprocessing import Pool
+
+# Rows are converted in chunks, by a pool of processes when --jobs is given
+CHUNK_ROWS = 20000
+IO_BUFFER = 1 << 20
+
+# Decoded addresses kept per process, for addresses repeated in the input
+CACHE_SIZE = 1 << 16
+
+_cache = dict()
 
 
 def tocondensed(add_or_pk):
     return base58.b58decode(add_or_pk)[1:-4]
 
 
-def process(csvfile):
-    with open(csvfile, 'r') as f:
-        for i, row in enumerate(f):
-            if i == 0:
-                print(row[:-1] + ',ripemd')
-                continue
-            elif row.strip() == '':
-                break
+def bech32_program(address, trusted=False):
+    """ Gets the witness program of a bech32/bech32m address. Trusted addresses (e.g. written by btcposbal2csv) are
+    decoded without verifying their checksum.
+    """
+
+    if not trusted:
+        _, program = bech32.decode('bc', address)
+        return bytearray(program)
+
+    pos = address.rfind('1')
+    data = [bech32.CHARSET.find(x) for x in address[pos + 2:-6]]
+    return bytearray(bech32.convertbits(data, 5, 8, False))
+
+
+def ripemd(address, trusted=False):
+    try:
+        return _cache[address]
+    except KeyError:
+        pass
+
+    if address[:3].lower() == 'bc1':
+        ripemd_bin = bech32_program(address.lower(), trusted)
+    else:
+        ripemd_bin = tocondensed(address)
+    ripemd_encoded = binascii.hexlify(ripemd_bin).decode()
+
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[address] = ripemd_encoded
+    return ripemd_encoded
+
+
+def convert_chunk(task):
+    rows, trusted = task
+    out = []
+    for row in rows:
+        row = row.rstrip('\r\n')
+        out.append(row + ',' + ripemd(row.split(',', 1)[0], trusted))
+    return '\n'.join(out) + '\n'
 
-            if row[:3].lower() == 'bc1':
-                _, script_int = bech32.decode('bc', row.split(',')[0].lower())
-                ripemd_encoded = binascii.hexlify(bytearray(script_int))
+
+def read_chunks(f, trusted):
+    # The rows end with the first empty line
+    while True:
+        rows = list(islice(f, CHUNK_ROWS))
+        for i, row in enumerate(rows):
+            if row.strip() == '':
+                if i:
+                    yield rows[:i], trusted
+                return
+        if not rows:
+            return
+        yield rows, trusted
+
+
+def process(csvfile, out=None, jobs=1, trusted=False):
+    fout = open(out, 'w', IO_BUFFER) if out else sys.stdout
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        with open(csvfile, 'r', IO_BUFFER) as f:
+            header = f.readline()
+            if header.strip() == '':
+                return
+            fout.write(header.rstrip('\r\n') + ',ripemd\n')
+
+            chunks = read_chunks(f, trusted)
+            if pool is None:
+                converted = (convert_chunk(chunk) for chunk in chunks)
             else:
-                ripemd_bin = tocondensed(row.split(',')[0])
-                ripemd_encoded = binascii.hexlify(ripemd_bin)
-            print(row[: -1] + ',' + ripemd_encoded.decode())
+                converted = pool.imap(convert_chunk, chunks)
+            for text in converted:
+                fout.write(text)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if out:
+            fout.close()
+        else:
+            fout.flush()
 
 
 def input_args():
@@ -36,6 +112,25 @@ def input_args():
         type=str,
         help='path to csv file with btc address in first column (usually output of btcposbal2csv)'
     )
+    parser.add_argument(
+        '--out',
+        metavar='OUTFILE',
+        type=str,
+        default=None,
+        help='output csv file, default stdout'
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='number of worker processes, default 1'
+    )
+    parser.add_argument(
+        '--trusted',
+        action='store_true',
+        help='do not verify the checksum of bech32 addresses, for input written by btcposbal2csv'
+    )
 
     a = parser.parse_args()
     return a
@@ -43,4 +138,4 @@ def input_args():
 
 if __name__ == '__main__':
     args = input_args()
-    process(args.csvin)
\ No newline at end of file
+    process(args.csvin, args.out, args.jobs, args.trusted)
@@ -0,0 +1,173 @@
+import os
+import shutil
+import struct
+import tempfile
+from heapq import merge
+from utils import ADDRESS_KEY_SIZE
+
+# External memory aggregation of (address key, amount, height) records. Records are aggregated in memory until the
+# memory budget is reached, then written to a temporary file sorted by address key (a run). Once all the records are
+# read, the runs are merged and the amounts summed per address in a single streaming pass.
+
+# Rough memory cost of one aggregated address while it is held in memory (key, dict entry, list and ints)
+BYTES_PER_ENTRY = 200
+
+# Run files are read and written through large buffers, so that the disk access is sequential
+IO_BUFFER = 1 << 20
+
+# Fixed-width run record: key length, key (zero padded), amount, height
+RECORD = struct.Struct('>B%dsQL' % ADDRESS_KEY_SIZE)
+
+
+def write_run(records, tmpdir):
+    """ Writes sorted records to a new run file.
+
+    :param records: Sorted (key, amount, height) records.
+    :type records: iterable
+    :param tmpdir: Directory where the run file is created.
+    :type tmpdir: str
+    :return: Path to the run file.
+    :rtype: str
+    """
+
+    fd, path = tempfile.mkstemp(dir=tmpdir, suffix='.run')
+    pack = RECORD.pack
+    with os.fdopen(fd, 'wb', IO_BUFFER) as f:
+        for key, amount, height in records:
+            f.write(pack(len(key), key, amount, height))
+    return path
+
+
+def read_run(path, tag=None):
+    """ Reads the records of a run file. If a tag is given, it is yielded as the second item of every record so that
+    records with the same key from different runs are merged in run order.
+
+    :param path: Path to the run file.
+    :type path: str
+    :param tag: Optional tag of the run.
+    :return: Generator of (key, amount, height), or (key, tag, amount, height) records.
+    :rtype: generator
+    """
+
+    size = RECORD.size
+    unpack = RECORD.unpack
+    with open(path, 'rb', IO_BUFFER) as f:
+        while True:
+            data = f.read(size)
+            if len(data) < size:
+                return
+            l_key, key, amount, height = unpack(data)
+            if tag is None:
+                yield key[:l_key], amount, height
+            else:
+                yield key[:l_key], tag, amount, height
+
+
+def read_run_by_amount(path, sign):
+    """ Reads the records of a run file sorted by amount as (sign * amount, key, height, amount), for merging.
+    """
+
+    for key, amount, height in read_run(path):
+        yield sign * amount, key, height, amount
+
+
+def spill(add_dict, tmpdir):
+    """ Writes the addresses aggregated in memory to a new run file, sorted by address key.
+    """
+
+    return write_run(((key, add_dict[key][0], add_dict[key][1]) for key in sorted(add_dict)), tmpdir)
+
+
+def external_aggregate(add_iter, mem_budget, tmpdir=None):
+    """ Aggregates (address key, amount, height) records per address with bounded memory. The amounts are summed and
+    the height is the one of the last record of the address, same as in the in memory aggregation.
+
+    :param add_iter: The records, as yielded by parse_ldb.
+    :type add_iter: iterable
+    :param mem_budget: Memory (in bytes) that can be used for the in memory part of the aggregation.
+    :type mem_budget: int
+    :param tmpdir: Directory where the run files are created, defaults to the system temporary directory.
+    :type tmpdir: str
+    :return: Generator of (address key, amount, height), sorted by address key.
+    :rtype: generator
+    """
+
+    max_entries = max(1, mem_budget // BYTES_PER_ENTRY)
+    rundir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        runs = []
+        add_dict = dict()
+        for key, val, height in add_iter:
+            if key in add_dict:
+                add_dict[key][0] += val
+                add_dict[key][1] = height
+            else:
+                add_dict[key] = [val, height]
+                if len(add_dict) >= max_entries:
+                    runs.append(spill(add_dict, rundir))
+                    add_dict = dict()
+        if add_dict:
+            runs.append(spill(add_dict, rundir))
+        add_dict = None
+
+        # Every run holds each address at most once, records with the same key are merged in the order of the runs.
+        last_key = None
+        amount = height = 0
+        for key, _, val, h in merge(*[read_run(path, i) for i, path in enumerate(runs)]):
+            if key != last_key:
+                if last_key is not None:
+                    yield last_key, amount, height
+                last_key = key
+                amount = 0
+            amount += val
+            height = h
+        if last_key is not None:
+            yield last_key, amount, height
+    finally:
+        shutil.rmtree(rundir)
+
+
+def external_sort_by_amount(add_iter, mem_budget, descending=False, tmpdir=None):
+    """ Sorts (address key, amount, height) records by amount with bounded memory.
+
+    :param add_iter: The records.
+    :type add_iter: iterable
+    :param mem_budget: Memory (in bytes) that can be used to sort the records in memory.
+    :type mem_budget: int
+    :param descending: Sort by descending amount.
+    :type descending: bool
+    :param tmpdir: Directory where the run files are created, defaults to the system temporary directory.
+    :type tmpdir: str
+    :return: Generator of (address key, amount, height), sorted by amount.
+    :rtype: generator
+    """
+
+    max_entries = max(1, mem_budget // BYTES_PER_ENTRY)
+    rundir = tempfile.mkdtemp(dir=tmpdir)
+
+    def sort_key(record):
+        return record[1]
+
+    try:
+        runs = []
+        buf = []
+        for record in add_iter:
+            buf.append(record)
+            if len(buf) >= max_entries:
+                buf.sort(key=sort_key, reverse=descending)
+                runs.append(write_run(buf, rundir))
+                buf = []
+        buf.sort(key=sort_key, reverse=descending)
+        if not runs:
+            for record in buf:
+                yield record
+            return
+        runs.append(write_run(buf, rundir))
+        buf = None
+
+        # Address keys are unique, so they break the ties between equal amounts.
+        sign = -1 if descending else 1
+        for _, key, height, amount in merge(*[read_run_by_amount(path, sign) for path in runs]):
+            yield key, amount, height
+    finally:
+        shutil.rmtree(rundir)
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+from bisect import bisect_left
+from utils import ADDRESS_KEY_SIZE, encode_address_key, decode_address
+from extsort import RECORD, IO_BUFFER, external_aggregate, external_sort_by_amount
+
+# Persistent balance index, a directory holding:
+#   - balances.bin: fixed-width records (key length, zero padded address key, amount, height, see extsort.RECORD)
+#     sorted by address key, searched by bisection in a memory map
+#   - by_amount.bin: the record numbers (uint32) sorted by descending amount, for the top addresses
+#   - index.json: the format version and the number of addresses
+# The zero padding keeps the key order, the type byte leading the key gives its length.
+
+INDEX_FORMAT = 1
+ROW = struct.Struct('>L')
+
+# Memory used to sort the addresses while the index is built
+INDEX_MEM = 256 * 1024 * 1024
+
+
+def write_index(add_iter, out, mem_budget=INDEX_MEM, tmpdir=None):
+    """ Writes the funded addresses to a balance index.
+
+    :param add_iter: The (address key, amount, height) of the addresses, in any order.
+    :type add_iter: iterable
+    :param out: Path to the index directory, created if it does not exist.
+    :type out: str
+    :param mem_budget: Memory (in bytes) used to sort the addresses before spilling to disk.
+    :type mem_budget: int
+    :param tmpdir: Directory of the temporary files, defaults to the system temporary directory.
+    :type tmpdir: str
+    :return: The number of addresses written.
+    :rtype: int
+    """
+
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
+    # Every address comes once, so the external aggregation only sorts them by key
+    add_iter = ((key, amount, height) for key, amount, height in add_iter if amount != 0)
+    count = 0
+    pack = RECORD.pack
+    with open(os.path.join(out, 'balances.bin'), 'wb', IO_BUFFER) as f:
+        for key, amount, height in external_aggregate(add_iter, mem_budget, tmpdir):
+            f.write(pack(len(key), key, amount, height))
+            count += 1
+
+    # The record number takes the place of the height, to be sorted along with the amount
+    rows = ((key, amount, row) for row, (key, amount, _) in enumerate(iter_records(out)))
+    pack = ROW.pack
+    with open(os.path.join(out, 'by_amount.bin'), 'wb', IO_BUFFER) as f:
+        for _, _, row in external_sort_by_amount(rows, mem_budget, descending=True, tmpdir=tmpdir):
+            f.write(pack(row))
+
+    with open(os.path.join(out, 'index.json'), 'w') as f:
+        json.dump({'format': INDEX_FORMAT, 'addresses': count}, f)
+        f.write('\n')
+
+    return count
+
+
+def iter_records(path):
+    """ Reads the records of balances.bin of an index in key order.
+    """
+
+    size = RECORD.size
+    unpack = RECORD.unpack
+    with open(os.path.join(path, 'balances.bin'), 'rb', IO_BUFFER) as f:
+        while True:
+            data = f.read(size)
+            if len(data) < size:
+                return
+            l_key, key, amount, height = unpack(data)
+            yield key[:l_key], amount, height
+
+
+class _Keys(object):
+    """ Padded keys of the records of a memory map, as a sequence for bisect.
+    """
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = i * RECORD.size + 1
+        return self.data[start:start + ADDRESS_KEY_SIZE]
+
+
+class BalanceIndex(object):
+    """ Balance index (see write_index) opened for queries. The files are memory mapped, so lookups only read the pages
+    they touch and the index does not need to fit in memory.
+
+    :param path: Path to the index directory.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            info = json.load(f)
+        if info.get('format') != INDEX_FORMAT:
+            raise Exception('%s is not a balance index of format %d' % (path, INDEX_FORMAT))
+        self.count = info['addresses']
+
+        self.files = []
+        self.records = self._map(os.path.join(path, 'balances.bin'))
+        self.by_amount = self._map(os.path.join(path, 'by_amount.bin'))
+        self.keys = _Keys(self.records, self.count)
+
+    def _map(self, path):
+        f = open(path, 'rb')
+        self.files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, row):
+        l_key, key, amount, height = RECORD.unpack_from(self.records, row * RECORD.size)
+        return key[:l_key], amount, height
+
+    def get(self, key):
+        """ Gets the balance of an address key.
+
+        :param key: The address key (see utils.encode_address_key).
+        :type key: bytes
+        :return: The amount and the last height, or None if the address has no balance.
+        :rtype: int, int
+        """
+
+        padded = key.ljust(ADDRESS_KEY_SIZE, b'\0')
+        row = bisect_left(self.keys, padded)
+        if row == self.count or self.keys[row] != padded:
+            return None
+        _, amount, height = self.record(row)
+        return amount, height
+
+    def balance(self, address):
+        """ Gets the balance of an address, see get.
+        """
+
+        key = decode_address(address)
+        if key is None:
+            raise Exception('invalid address %s' % address)
+        return self.get(key)
+
+    def get_many(self, keys):
+        """ Gets the balances of several address keys, looked up in key order so that neighbouring keys share pages.
+
+        :param keys: The address keys.
+        :type keys: iterable
+        :return: The (amount, height) or None of every key, by key.
+        :rtype: dict
+        """
+
+        return dict((key, self.get(key)) for key in sorted(set(keys)))
+
+    def top(self, n):
+        """ Iterates over the n addresses with the highest balances.
+
+        :param n: Number of addresses.
+        :type n: int
+        :return: Generator of (address key, amount, height), by descending amount.
+        :rtype: generator
+        """
+
+        for i in range(min(n, self.count)):
+            row, = ROW.unpack_from(self.by_amount, i * ROW.size)
+            yield self.record(row)
+
+    def items(self):
+        for row in range(self.count):
+            yield self.record(row)
+
+    def close(self):
+        for data in (self.records, self.by_amount):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def input_args():
+    parser = argparse.ArgumentParser(description='Query a balance index written by btcposbal2csv (--out_format index),'
+                                                 ' writes csv to stdout')
+    parser.add_argument(
+        'index',
+        metavar='PATH_TO_INDEX_DIR',
+        type=str,
+        help='path to the balance index directory'
+    )
+    parser.add_argument(
+        'addresses',
+        metavar='ADDRESS',
+        type=str,
+        nargs='*',
+        help='addresses to look up'
+    )
+    parser.add_argument(
+        '--file',
+        metavar='PATH_TO_ADDRESS_FILE',
+        type=str,
+        default=None,
+        help='look up the addresses of this file, one per line (or in the first column of a csv)'
+    )
+    parser.add_argument(
+        '--top',
+        metavar='N',
+        type=int,
+        default=None,
+        help='list the N addresses with the highest balances'
+    )
+    # The addresses may follow the options
+    return getattr(parser, 'parse_intermixed_args', parser.parse_args)()
+
+
+if __name__ == '__main__':
+    args = input_args()
+
+    addresses = list(args.addresses)
+    if args.file:
+        with open(args.file) as f:
+            # Lines which are not an address (e.g. a csv header) are skipped
+            addresses += [address for address in (line.split(',', 1)[0].strip() for line in f)
+                          if address and decode_address(address) is not None]
+
+    with BalanceIndex(args.index) as index:
+        out = sys.stdout
+        out.write('address,value_satoshi,last_height\n')
+        if args.top is not None:
+            for key, amount, height in index.top(args.top):
+                out.write('%s,%d,%d\n' % (encode_address_key(key), amount, height))
+        keys = dict((address, decode_address(address)) for address in addresses)
+        found = index.get_many(key for key in keys.values() if key is not None)
+        for address in addresses:
+            balance = found.get(keys[address])
+            if balance is None:
+                # Unknown and invalid addresses have no balance
+                out.write('%s,0,\n' % address)
+            else:
+                out.write('%s,%d,%d\n' % ((address,) + balance))
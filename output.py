@@ -0,0 +1,405 @@
+import os
+import sys
+import gzip
+import json
+import struct
+import importlib
+from array import array
+from queue import Queue
+from threading import Thread
+from binascii import hexlify
+from utils import encode_address_key, address_key_type, ADDRESS_KEY_SIZE, UINT64
+from index import write_index
+
+OUT_FORMATS = ('csv', 'csv.gz', 'csv.zst', 'npy', 'parquet', 'index')
+ADDRESS_FORMATS = ('address', 'ripemd', 'both')
+
+# Optional packages needed by the output formats
+OUT_FORMAT_PACKAGES = {'csv.zst': 'zstandard', 'parquet': 'pyarrow'}
+
+# Output files are written through large buffers, rows are handed to the writer thread in chunks
+IO_BUFFER = 1 << 20
+CHUNK_ROWS = 10000
+
+# Chunks waiting for the writer thread, bounds the memory used when the output is slower than the scan
+QUEUE_CHUNKS = 16
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Columnar outputs hold the address key split in the type byte and the hash, zero padded to a fixed width
+HASH_SIZE = ADDRESS_KEY_SIZE - 1
+
+# The .npy header is written once the number of rows is known, it has a fixed size so that the data can be written first
+NPY_HEADER_SIZE = 128
+NPY_COLUMNS = (
+    ('address_type', '|u1'),
+    ('address_hash', '|u1'),
+    ('value_satoshi', '<u8'),
+    ('last_height', '<u4'),
+)
+
+
+# The metadata of an output (e.g. the best block of the chainstate it was made from) is written next to it
+META_SUFFIX = '.meta.json'
+
+
+def meta_path(out):
+    return out.rstrip('/' + os.sep) + META_SUFFIX
+
+
+def read_meta(out):
+    """ Reads the metadata of an output, see write_meta.
+
+    :param out: Path to the output file (directory for npy).
+    :type out: str
+    :return: The metadata, or None if the output or its metadata do not exist.
+    :rtype: dict
+    """
+
+    path = meta_path(out)
+    if not os.path.exists(out) or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+
+
+def write_meta(out, meta):
+    """ Writes the metadata of an output to a json file next to it (OUTFILE.meta.json).
+
+    :param out: Path to the output file (directory for npy).
+    :type out: str
+    :param meta: The metadata.
+    :type meta: dict
+    """
+
+    with open(meta_path(out), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def clear_meta(out):
+    """ Removes the metadata of an output about to be rewritten, so that an interrupted run does not leave an output
+    looking up to date.
+    """
+
+    path = meta_path(out)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def missing_package(out_format):
+    """ Gets the package needed by an output format which is not installed, None if the format can be written.
+    """
+
+    package = OUT_FORMAT_PACKAGES.get(out_format)
+    if package is not None:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            return package
+    return None
+
+
+def guess_out_format(out):
+    """ Gets the output format from the extension of the output file, defaults to plain csv.
+    """
+
+    for out_format in OUT_FORMATS:
+        if out.endswith('.' + out_format):
+            return out_format
+    if out.endswith('.pq'):
+        return 'parquet'
+    return 'csv'
+
+
+class ThreadedWriter(object):
+    """
+    Binary output stream compressed and written by a separate thread, so that the compression overlaps with the scan.
+    The data is passed through a bounded queue. Errors of the writer thread are raised by the next write or by close.
+    """
+
+    def __init__(self, out, out_format='csv'):
+        if out_format not in ('csv', 'csv.gz', 'csv.zst'):
+            raise Exception('unknown output format %s' % out_format)
+        if missing_package(out_format) is not None:
+            raise Exception('%s output needs the %s package' % (out_format, OUT_FORMAT_PACKAGES[out_format]))
+
+        if out == '-':
+            # sys.stdout may be redirected to stderr for the messages
+            self.raw = getattr(sys.__stdout__, 'buffer', sys.__stdout__)
+        else:
+            self.raw = open(out, 'wb', IO_BUFFER)
+
+        if out_format == 'csv':
+            self.stream = self.raw
+        elif out_format == 'csv.gz':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=GZIP_LEVEL)
+        else:
+            import zstandard
+            self.stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(self.raw, closefd=False)
+
+        self.out = out
+        self.error = None
+        self.queue = Queue(QUEUE_CHUNKS)
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.stream.write(data)
+                except Exception as e:
+                    # Keep consuming the queue, the error is raised in the main thread.
+                    self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            if self.stream is not self.raw:
+                self.stream.close()
+            self.raw.flush()
+        finally:
+            if self.out != '-':
+                self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def csv_rows(add_iter, address_format='address', encode=encode_address_key):
+    """ Formats the funded addresses as csv rows, header first.
+
+    :param add_iter: The (address key, amount, height) of the funded addresses.
+    :type add_iter: iterable
+    :param address_format: One of ADDRESS_FORMATS: the address, the type and hex hash of the address instead of the
+        address (no Base58/Bech32 encoding at all), or both the address and the hex hash (same columns as the output of
+        convert2ripemd160).
+    :type address_format: str
+    :param encode: Function encoding the address keys (see encode_address_key).
+    :type encode: function
+    :return: Generator of the rows.
+    :rtype: generator
+    """
+
+    if address_format == 'address':
+        yield 'address,value_satoshi,last_height'
+        for key, amount, height in add_iter:
+            yield '%s,%d,%d' % (encode(key), amount, height)
+    elif address_format == 'both':
+        yield 'address,value_satoshi,last_height,ripemd'
+        for key, amount, height in add_iter:
+            yield '%s,%d,%d,%s' % (encode(key), amount, height, hexlify(key[1:]).decode('ascii'))
+    elif address_format == 'ripemd':
+        yield 'type,ripemd,value_satoshi,last_height'
+        for key, amount, height in add_iter:
+            yield '%s,%s,%d,%d' % (address_key_type(key), hexlify(key[1:]).decode('ascii'), amount, height)
+    else:
+        raise Exception('unknown address format %s' % address_format)
+
+
+def write_csv(rows, out, out_format='csv'):
+    """ Writes csv rows (see csv_rows) to a csv file.
+
+    :param rows: The rows, header first.
+    :type rows: iterable
+    :param out: Path to the output file, or - for stdout.
+    :type out: str
+    :param out_format: One of the csv OUT_FORMATS.
+    :type out_format: str
+    :return: The number of rows written, without the header.
+    :rtype: int
+    """
+
+    count = -1
+    with ThreadedWriter(out, out_format) as f:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            count += 1
+            if len(chunk) == CHUNK_ROWS:
+                f.write(('\n'.join(chunk) + '\n').encode('ascii'))
+                chunk = []
+        # The csv ends with an empty line
+        chunk.append('')
+        f.write(('\n'.join(chunk) + '\n').encode('ascii'))
+
+    return count
+
+
+def funded_chunks(add_iter, size):
+    """ Groups the funded (address key, amount, height) records in lists of the given size.
+    """
+
+    chunk = []
+    for record in add_iter:
+        if record[1] == 0:
+            continue
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def npy_header(descr, shape):
+    """ Builds the header of a NumPy .npy (format 1.0) file, padded to NPY_HEADER_SIZE.
+    """
+
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%s), }" % (
+        descr, ', '.join('%d' % n for n in shape) + (',' if len(shape) == 1 else ''))
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('ascii')
+
+
+def write_npy(add_iter, out):
+    """ Writes the funded addresses as a directory of NumPy .npy files, one per column, which can be memory mapped
+    (numpy.load(path, mmap_mode='r')). NumPy is not needed to write them.
+
+    :param add_iter: The (address key, amount, height) of the addresses.
+    :type add_iter: iterable
+    :param out: Path to the output directory, created if it does not exist.
+    :type out: str
+    :return: The number of addresses written.
+    :rtype: int
+    """
+
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
+    files = [open(os.path.join(out, name + '.npy'), 'wb', IO_BUFFER) for name, _ in NPY_COLUMNS]
+    try:
+        for f in files:
+            f.write(b'\0' * NPY_HEADER_SIZE)
+
+        count = 0
+        padding = b'\0' * HASH_SIZE
+        for chunk in funded_chunks(add_iter, CHUNK_ROWS):
+            types = array('B', [bytearray(key[:1])[0] for key, _, _ in chunk])
+            hashes = b''.join((key[1:] + padding)[:HASH_SIZE] for key, _, _ in chunk)
+            amounts = array(UINT64, [amount for _, amount, _ in chunk])
+            heights = array('I', [height for _, _, height in chunk])
+            if sys.byteorder == 'big':
+                amounts.byteswap()
+                heights.byteswap()
+            types.tofile(files[0])
+            files[1].write(hashes)
+            amounts.tofile(files[2])
+            heights.tofile(files[3])
+            count += len(chunk)
+
+        shapes = ((count,), (count, HASH_SIZE), (count,), (count,))
+        for f, (_, descr), shape in zip(files, NPY_COLUMNS, shapes):
+            f.seek(0)
+            f.write(npy_header(descr, shape))
+    finally:
+        for f in files:
+            f.close()
+
+    return count
+
+
+def write_parquet(add_iter, out, meta=None):
+    """ Writes the funded addresses to a Parquet file (needs pyarrow).
+
+    :param add_iter: The (address key, amount, height) of the addresses.
+    :type add_iter: iterable
+    :param out: Path to the output file.
+    :type out: str
+    :param meta: Metadata stored (as strings) in the schema of the file.
+    :type meta: dict
+    :return: The number of addresses written.
+    :rtype: int
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('parquet output needs the pyarrow package')
+
+    schema = pyarrow.schema([
+        ('address_type', pyarrow.uint8()),
+        ('address_hash', pyarrow.binary(HASH_SIZE)),
+        ('value_satoshi', pyarrow.uint64()),
+        ('last_height', pyarrow.uint32()),
+    ])
+    if meta:
+        schema = schema.with_metadata(dict((k, str(v)) for k, v in meta.items()))
+
+    count = 0
+    padding = b'\0' * HASH_SIZE
+    writer = pyarrow.parquet.ParquetWriter(out, schema)
+    try:
+        for chunk in funded_chunks(add_iter, 10 * CHUNK_ROWS):
+            writer.write_table(pyarrow.Table.from_arrays([
+                pyarrow.array([bytearray(key[:1])[0] for key, _, _ in chunk], pyarrow.uint8()),
+                pyarrow.array([(key[1:] + padding)[:HASH_SIZE] for key, _, _ in chunk], pyarrow.binary(HASH_SIZE)),
+                pyarrow.array([amount for _, amount, _ in chunk], pyarrow.uint64()),
+                pyarrow.array([height for _, _, height in chunk], pyarrow.uint32()),
+            ], schema=schema))
+            count += len(chunk)
+    finally:
+        writer.close()
+
+    return count
+
+
+def write_output(add_iter, out, out_format='csv', address_format='address', stats=None, meta=None):
+    """ Writes the funded addresses in the given format. Addresses are encoded here for the csv formats, the columnar
+    formats hold the binary address keys.
+
+    :param add_iter: The (address key, amount, height) of the addresses.
+    :type add_iter: iterable
+    :param out: Path to the output file (directory for npy and index), or - for stdout (csv formats).
+    :type out: str
+    :param out_format: One of OUT_FORMATS.
+    :type out_format: str
+    :param address_format: One of ADDRESS_FORMATS, for the csv formats (see csv_rows).
+    :type address_format: str
+    :param stats: Stats of the run (see stats.Stats), getting the records is accounted to the aggregation.
+    :type stats: Stats
+    :param meta: Metadata known before the output is written (e.g. the best block), stored in the Parquet schema.
+    :type meta: dict
+    :return: The number of addresses written.
+    :rtype: int
+    """
+
+    encode = encode_address_key
+    if stats is not None:
+        add_iter = stats.timed_iter(add_iter, 'aggregate', 'output')
+        encode = stats.timed_func(encode, 'encode', 'output')
+
+    if out_format == 'npy':
+        count = write_npy(add_iter, out)
+    elif out_format == 'parquet':
+        count = write_parquet(add_iter, out, meta)
+    elif out_format == 'index':
+        count = write_index(add_iter, out)
+    else:
+        add_iter = ((key, amount, height) for key, amount, height in add_iter if amount != 0)
+        count = write_csv(csv_rows(add_iter, address_format, encode), out, out_format)
+
+    if stats is not None:
+        stats.add('addresses', count)
+    return count
@@ -0,0 +1,172 @@
+import traceback
+import multiprocessing
+from queue import Empty
+import plyvel
+from utils import utxo_prefix, open_chainstate, deobfuscator, OutputDecoder
+from stats import Stats
+
+# Pipelined scan of the chainstate: a reader process iterates over the LevelDB and hands the raw values in chunks to
+# decoder processes, through a bounded queue. The decoded outputs come back in chunks through a second bounded queue and
+# are put back in the order of the chainstate, so that the records are the same, in the same order, as parse_ldb's.
+
+# Values per chunk, and chunks per decoder process waiting in each of the queues
+CHUNK_VALUES = 5000
+QUEUE_CHUNKS = 4
+
+# The processes are spawned rather than forked: a forked child inherits the LevelDB state of the parent (which opened
+# the chainstate to get the obfuscation key) without its background compaction thread, and closing a database whose
+# compaction it scheduled would wait forever.
+CONTEXT = multiprocessing.get_context('spawn')
+
+# Seconds between the checks that the processes are still running while their results are waited for. A process
+# killed (e.g. out of memory) does not post its error.
+PIPELINE_POLL = 1.0
+
+
+def read_chunks(fin_name, prefix, tuning, workers, tasks, results):
+    """ Reader process: puts (sequence number, raw values) chunks in the tasks queue, then a None per decoder.
+    """
+
+    try:
+        db, read_options = open_chainstate(fin_name, tuning)
+        try:
+            chunk = []
+            seq = 0
+            for value in db.iterator(prefix=prefix, include_key=False, **read_options):
+                chunk.append(value)
+                if len(chunk) == CHUNK_VALUES:
+                    tasks.put((seq, chunk))
+                    seq += 1
+                    chunk = []
+            if chunk:
+                tasks.put((seq, chunk))
+        finally:
+            db.close()
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+    finally:
+        for _ in range(workers):
+            tasks.put(None)
+
+
+def decode_chunks(o_key, version, types, keys, timed, tasks, results):
+    """ Decoder process: decodes the chunks of the tasks queue into chunks of (address key, amount, height) records (see
+    parse_ldb), put in the results queue. Its stats are sent once the tasks are exhausted.
+    """
+
+    try:
+        stats = Stats(timed=timed, progress=False)
+        clock = stats.clock if timed else None
+        deobfuscate = bytearray if o_key is None else deobfuscator(o_key[1:])
+        decoder = OutputDecoder(deobfuscate, version, types, keys, clock, reader='decode', consumer='decode')
+
+        while True:
+            if clock:
+                clock(None)
+            task = tasks.get()
+            if task is None:
+                break
+            seq, chunk = task
+            records = list(decoder.iter_outputs(chunk))
+            if clock:
+                clock(None)
+            results.put(('chunk', (seq, records)))
+
+        decoder.add_to(stats)
+        results.put(('done', stats))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def parse_ldb_pipelined(fin_name, version=0.15, types=(0, 1), workers=2, not_decoded=None, stats=None, keys=None,
+                        tuning=None):
+    """ Iterates over the UTXO set in the chainstate like parse_ldb (same records, in the same order), the LevelDB
+    reading and the decoding being done by separate processes: one reader and workers decoders. The consumer of the
+    records (the aggregation) runs in the calling process.
+
+    If a not_decoded list is given, the count and total amount of the outputs which could not be decoded are added to it
+    and neither the progress nor the totals are printed. For timed stats (see stats.Stats), the time the decoders spend
+    de-obfuscating and decoding is added up, and the time spent waiting for them is accounted to the reading. The
+    tuning options apply to the reader, see utils.SCAN_TUNING.
+    """
+
+    verbose = not_decoded is None
+    if stats is None:
+        stats = Stats(progress=verbose)
+    clock = stats.clock if stats.timed else None
+
+    db = plyvel.DB(fin_name, compression=None)
+    try:
+        o_key = db.get(b'\x0e\x00obfuscate_key')
+    finally:
+        db.close()
+
+    tasks = CONTEXT.Queue(QUEUE_CHUNKS * workers)
+    results = CONTEXT.Queue(QUEUE_CHUNKS * workers)
+    processes = [CONTEXT.Process(target=read_chunks, name='reader',
+                                 args=(fin_name, utxo_prefix(version), tuning, workers, tasks, results))]
+    processes += [
+        CONTEXT.Process(target=decode_chunks, name='decoder-%d' % i,
+                        args=(o_key, version, types, keys, stats.timed, tasks, results))
+        for i in range(workers)
+    ]
+    for p in processes:
+        p.daemon = True
+        p.start()
+
+    try:
+        # Chunks decoded ahead of the next one in the chainstate order
+        pending = dict()
+        next_seq = 0
+        done = 0
+        counter = 0
+        skipped = [0, 0]
+        while done < workers:
+            if clock:
+                clock('iterate')
+            try:
+                kind, payload = results.get(timeout=PIPELINE_POLL)
+            except Empty:
+                for p in processes:
+                    if p.exitcode:
+                        raise Exception('pipeline process %s exited with code %d' % (p.name, p.exitcode))
+                continue
+            if kind == 'error':
+                raise Exception('pipeline worker failed:\n%s' % payload)
+            elif kind == 'done':
+                stats.merge(payload)
+                skipped[0] += payload.counters['not_decoded']
+                skipped[1] += payload.counters['not_decoded_satoshi']
+                done += 1
+                continue
+
+            seq, records = payload
+            pending[seq] = records
+            while next_seq in pending:
+                records = pending.pop(next_seq)
+                next_seq += 1
+                if clock:
+                    clock('aggregate')
+                for record in records:
+                    yield record
+                counter += len(records)
+                if verbose:
+                    stats.progress(counter)
+
+        if clock:
+            clock('aggregate')
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+    if verbose:
+        stats.end_progress()
+        print('unable to decode %d transactions' % skipped[0])
+        print('totaling %d satoshi' % skipped[1])
+    else:
+        not_decoded[0] += skipped[0]
+        not_decoded[1] += skipped[1]
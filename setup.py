@@ -0,0 +1,9 @@
+from setuptools import setup, Extension
+
+# Only builds the optional compiled decoder next to the scripts:
+#     python setup.py build_ext --inplace
+# The scripts work without it, see utils.decode_coin.
+setup(
+    name='btcposbal2csv',
+    ext_modules=[Extension('_coins', sources=['_coins.c'], optional=True)],
+)
@@ -0,0 +1,189 @@
+import struct
+import plyvel
+from utils import utxo_prefix, open_chainstate, chainstate_deobfuscator, OutputDecoder
+from stats import Stats, PROGRESS_EVERY
+
+# Persistent balance snapshot used by --incremental. The snapshot is a LevelDB holding:
+#   - chainstate key (b'C' + outpoint) -> amount, height, address key of every coin of the chainstate (empty value if
+#     the coin has no address of the requested types)
+#   - b'a' + address key -> amount, height of every funded address
+#   - b'm' -> format version and the requested types; if it does not match, the snapshot is rebuilt from scratch
+#   - b'h' -> highest height of the coins added to the snapshot
+# Coins never change once created, so the snapshot is brought up to date by a single merge of the (key sorted)
+# chainstate and snapshot outpoints: outpoints only in the chainstate are new coins, outpoints only in the snapshot
+# have been spent since.
+
+SNAPSHOT_FORMAT = 3
+
+COIN = struct.Struct('>QL')
+BALANCE = struct.Struct('>QL')
+HEIGHT = struct.Struct('>L')
+
+# Number of snapshot updates written at once
+BATCH_SIZE = 100000
+
+
+def snapshot_meta(types):
+    return ('%d %s' % (SNAPSHOT_FORMAT, ','.join(str(t) for t in sorted(types)))).encode('ascii')
+
+
+def clear_snapshot(snap):
+    batch = snap.write_batch()
+    for i, key in enumerate(snap.iterator(include_value=False)):
+        batch.delete(key)
+        if i % BATCH_SIZE == BATCH_SIZE - 1:
+            batch.write()
+            batch = snap.write_batch()
+    batch.write()
+
+
+def update_snapshot(fin_name, snapshot, version=0.15, types=(0, 1), stats=None, tuning=None):
+    """ Brings the balance snapshot up to date with the chainstate. A missing snapshot (or one made for other types) is
+    built from scratch, which takes longer than a plain scan.
+
+    :param fin_name: Path to the chainstate directory.
+    :type fin_name: str
+    :param snapshot: Path to the snapshot directory.
+    :type snapshot: str
+    :param version: Bitcoin Core version that created the chainstate LevelDB, 0.15 onwards.
+    :type version: float
+    :param types: Script types to be included.
+    :type types: iterable
+    :param stats: Stats of the run (see stats.Stats), for timed stats the de-obfuscation and decoding of the new coins
+        is accounted, the rest of the update to the aggregation. Nothing is printed if their progress is off.
+    :type stats: Stats
+    :param tuning: Read options of the chainstate, see utils.SCAN_TUNING.
+    :type tuning: dict
+    :return: The number of new and spent coins.
+    :rtype: int, int
+    """
+
+    if version < 0.15:
+        # Before 0.15 the chainstate holds one entry per transaction, which changes when some of its outputs are spent.
+        raise Exception("Incremental snapshots only work for version 0.15 onwards.")
+
+    prefix = utxo_prefix(version)
+    meta = snapshot_meta(types)
+    if stats is None:
+        stats = Stats()
+    clock = stats.clock if stats.timed else None
+    verbose = stats.show_progress
+
+    db, read_options = open_chainstate(fin_name, tuning)
+    snap = plyvel.DB(snapshot, create_if_missing=True)
+    try:
+        current = snap.get(b'm')
+        if current != meta:
+            if current is None and next(snap.iterator(include_value=False), None) is not None:
+                raise Exception('%s is not a balance snapshot' % snapshot)
+            if verbose:
+                print('building new snapshot')
+            clear_snapshot(snap)
+        # The snapshot stays marked as incomplete until all the changes are written.
+        snap.put(b'm', b'')
+
+        # Every new coin is decoded on its own, its record (if any) is the balance change of the coin
+        decoder = OutputDecoder(chainstate_deobfuscator(db), version, types, clock=clock, reader='aggregate')
+        iter_outputs = decoder.iter_outputs
+        pack_coin = COIN.pack
+        unpack_coin = COIN.unpack
+
+        # Balance changes per address key: [amount delta, height of the last new coin or None]
+        deltas = dict()
+        new = spent = 0
+        batch = snap.write_batch()
+        pending = 0
+
+        # Both are read once, in key order
+        chainstate = db.iterator(prefix=prefix, **read_options)
+        coins = snap.iterator(prefix=prefix, **read_options)
+        key = next(chainstate, None)
+        coin = next(coins, None)
+        while key is not None or coin is not None:
+            if coin is None or (key is not None and key[0] < coin[0]):
+                # New coin
+                outpoint, o_value = key
+                records = list(iter_outputs((o_value,)))
+                if records:
+                    add, amount, height = records[0]
+                    batch.put(outpoint, pack_coin(amount, height) + add)
+                    delta = deltas.setdefault(add, [0, None])
+                    delta[0] += amount
+                    delta[1] = height
+                else:
+                    batch.put(outpoint, b'')
+                new += 1
+                key = next(chainstate, None)
+            elif key is None or coin[0] < key[0]:
+                # Spent coin
+                outpoint, value = coin
+                if value:
+                    amount, _ = unpack_coin(value[:COIN.size])
+                    deltas.setdefault(value[COIN.size:], [0, None])[0] -= amount
+                batch.delete(outpoint)
+                spent += 1
+                coin = next(coins, None)
+            else:
+                # Unchanged coin
+                key = next(chainstate, None)
+                coin = next(coins, None)
+                continue
+
+            pending += 1
+            if pending == BATCH_SIZE:
+                batch.write()
+                batch = snap.write_batch()
+                pending = 0
+            if verbose and not (new + spent) & (PROGRESS_EVERY - 1):
+                stats.progress(new + spent, 'new and spent coins')
+        batch.write()
+
+        batch = snap.write_batch()
+        max_height = decoder.max_height
+        previous = snap.get(b'h')
+        if previous is not None:
+            max_height = max(max_height, HEIGHT.unpack(previous)[0])
+        batch.put(b'h', HEIGHT.pack(max_height))
+        for add, (amount, height) in deltas.items():
+            balance = snap.get(b'a' + add)
+            if balance is not None:
+                old_amount, old_height = BALANCE.unpack(balance)
+                amount += old_amount
+                if height is None:
+                    height = old_height
+            if amount > 0:
+                batch.put(b'a' + add, BALANCE.pack(amount, height))
+            elif balance is not None:
+                batch.delete(b'a' + add)
+        batch.put(b'm', meta)
+        batch.write()
+    finally:
+        snap.close()
+        db.close()
+
+    stats.add('new_coins', new)
+    stats.add('spent_coins', spent)
+    stats.maximum('max_height', max_height)
+    if verbose:
+        stats.end_progress()
+        print('new coins: %d spent coins: %d' % (new, spent))
+    return new, spent
+
+
+def iter_balances(snapshot):
+    """ Iterates over the funded addresses of a balance snapshot.
+
+    :param snapshot: Path to the snapshot directory.
+    :type snapshot: str
+    :return: Generator of (address key, amount, height), sorted by address key.
+    :rtype: generator
+    """
+
+    snap = plyvel.DB(snapshot)
+    try:
+        unpack = BALANCE.unpack
+        for key, value in snap.iterator(prefix=b'a'):
+            amount, height = unpack(value)
+            yield key[1:], amount, height
+    finally:
+        snap.close()
@@ -0,0 +1,162 @@
+import sys
+import json
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Stages the time of a run is split into. The time is accounted exclusively: at any moment the run is in a single
+# stage, the one given by the last Stats.clock call.
+STAGES = ('iterate', 'deobfuscate', 'decode', 'aggregate', 'encode', 'output')
+
+# Progress is written at most once per interval (seconds), the time is only checked every PROGRESS_EVERY records
+PROGRESS_INTERVAL = 1.0
+PROGRESS_EVERY = 1 << 12
+
+
+def peak_rss_mb():
+    """ Gets the peak resident memory of the current process in MB, or None where it is not available.
+    """
+
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class Stats(object):
+    """
+    Timers and counters of a run. Stage timers are only kept when timed is set, as they cost a couple of clock reads
+    per record. Progress is reported to stderr, rate-limited by time.
+    """
+
+    def __init__(self, timed=False, progress=True):
+        self.timed = timed
+        self.show_progress = progress
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self.counters = dict()
+        self.maxima = dict()
+        self.stage = None
+        self.start = self.last = time.time()
+        self.next_progress = self.start + PROGRESS_INTERVAL
+
+    def clock(self, stage):
+        """ Accounts the time since the previous call to the stage the run was in, and enters the given stage.
+        """
+
+        now = time.time()
+        if self.stage is not None:
+            self.seconds[self.stage] += now - self.last
+        self.stage = stage
+        self.last = now
+
+    def timed_iter(self, iterable, stage, consumer):
+        """ Wraps an iterable so that getting its items is accounted to stage, and the rest to consumer.
+        """
+
+        if not self.timed:
+            return iterable
+        return self._timed_iter(iterable, stage, consumer)
+
+    def _timed_iter(self, iterable, stage, consumer):
+        clock = self.clock
+        iterator = iter(iterable)
+        while True:
+            clock(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                clock(consumer)
+                return
+            clock(consumer)
+            yield item
+
+    def timed_func(self, function, stage, caller):
+        """ Wraps a function so that its calls are accounted to stage, and the rest to caller.
+        """
+
+        if not self.timed:
+            return function
+        clock = self.clock
+
+        def timed(*args):
+            clock(stage)
+            result = function(*args)
+            clock(caller)
+            return result
+
+        return timed
+
+    def add(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def maximum(self, name, value):
+        if value > self.maxima.get(name, value - 1):
+            self.maxima[name] = value
+
+    def merge(self, other):
+        """ Adds the timers and counters of another run (e.g. of a worker process).
+        """
+
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        for name, n in other.counters.items():
+            self.add(name, n)
+        for name, value in other.maxima.items():
+            self.maximum(name, value)
+
+    def progress(self, counter, label='parsed transactions'):
+        """ Writes the number of parsed outputs (or of what label says) to stderr, if the last report is old enough.
+        """
+
+        if not self.show_progress:
+            return
+        now = time.time()
+        if now >= self.next_progress:
+            self.next_progress = now + PROGRESS_INTERVAL
+            sys.stderr.write('\r %s: %d (%.0f/s)' % (label, counter, counter / max(now - self.start, 1e-9)))
+            sys.stderr.flush()
+
+    def end_progress(self):
+        if self.show_progress and self.next_progress > self.start + PROGRESS_INTERVAL:
+            sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    def report(self):
+        """ Gets the totals, rates and peak memory of the run.
+
+        :return: The report, with the wall time, the seconds and share of every stage (summed over the worker processes
+            for --jobs), the counters and their rates per wall second, the maxima (e.g. the highest coin height) and the
+            peak RSS in MB.
+        :rtype: dict
+        """
+
+        self.clock(None)
+        wall = time.time() - self.start
+        report = {'wall_seconds': wall, 'peak_rss_mb': peak_rss_mb(), 'counters': dict(self.counters),
+                  'maxima': dict(self.maxima)}
+        report['rates'] = dict((name, n / max(wall, 1e-9)) for name, n in self.counters.items())
+        if self.timed:
+            report['stages'] = dict(
+                (stage, {'seconds': seconds, 'share': seconds / max(wall, 1e-9)})
+                for stage, seconds in self.seconds.items()
+            )
+        return report
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def __getstate__(self):
+        return self.timed, self.show_progress, self.seconds, self.counters, self.maxima
+
+    def __setstate__(self, state):
+        self.timed, self.show_progress, self.seconds, self.counters, self.maxima = state
+        self.stage = None
+        self.start = self.last = time.time()
+        self.next_progress = self.start + PROGRESS_INTERVAL
@@ -0,0 +1,80 @@
+import random
+import unittest
+import utils
+from bench import random_coin, random_bytes, serialize_coin, b128_encode
+
+try:
+    import _coins
+except ImportError:
+    _coins = None
+
+# Cross-check of the compiled decoder (_coins.c) against the pure Python one (utils.py_decode_coin): for any input,
+# both must give the same coin or raise the same exception type.
+
+COINS = 20000
+
+
+def outcome(decode, value):
+    try:
+        return decode(value)
+    except Exception as e:
+        return type(e)
+
+
+def generated_coins(count, seed=1):
+    rnd = random.Random(seed)
+    hashes = [random_bytes(rnd, 20) for _ in range(100)]
+    programs = [random_bytes(rnd, 32) for _ in range(10)]
+    return [bytes(serialize_coin(*random_coin(rnd, hashes, programs))) for _ in range(count)]
+
+
+class PyDecodeCoinTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rnd = random.Random(2)
+        hashes = [random_bytes(rnd, 20) for _ in range(100)]
+        programs = [random_bytes(rnd, 32) for _ in range(10)]
+        for _ in range(COINS):
+            height, coinbase, amount, out_type, script = random_coin(rnd, hashes, programs)
+            coin = bytes(serialize_coin(height, coinbase, amount, out_type, script))
+            self.assertEqual(utils.py_decode_coin(coin), (height, coinbase, amount, out_type, bytes(script)))
+
+
+@unittest.skipIf(_coins is None, 'the compiled decoder is not built (python setup.py build_ext --inplace)')
+class CompiledDecodeCoinTest(unittest.TestCase):
+
+    def assert_same(self, values):
+        for value in values:
+            self.assertEqual(outcome(_coins.decode_coin, value), outcome(utils.py_decode_coin, value), repr(value))
+
+    def test_generated_coins(self):
+        self.assert_same(generated_coins(COINS))
+
+    def test_bytearray(self):
+        self.assert_same([bytearray(value) for value in generated_coins(100)])
+
+    def test_truncated_coins(self):
+        self.assert_same(value[:i] for value in generated_coins(200) for i in range(len(value)))
+
+    def test_extended_coins(self):
+        self.assert_same(value + b'\x00' for value in generated_coins(200))
+
+    def test_garbage(self):
+        rnd = random.Random(3)
+        self.assert_same(bytes(random_bytes(rnd, rnd.randint(0, 60))) for _ in range(COINS))
+
+    def test_large_values(self):
+        # Varints and amounts which do not fit in 64 bits, and script sizes beyond the coin
+        script = b'\x11' * 20
+        values = []
+        for n in (2 ** 63, 2 ** 64 - 1, 2 ** 64, 2 ** 70, 2 ** 200):
+            values.append(bytes(b128_encode(n) + b128_encode(1) + b128_encode(0)) + script)
+            values.append(bytes(b128_encode(2) + b128_encode(n) + b128_encode(0)) + script)
+            values.append(bytes(b128_encode(2) + b128_encode(1) + b128_encode(n)) + script)
+        values.append(b'\xff' * 12 + b'\x00')
+        values.append(b'\x02\x01' + b'\xff' * 9 + b'\x7f')
+        self.assert_same(values)
+
+
+if __name__ == '__main__':
+    unittest.main()
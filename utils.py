@@ -1,9 +1,13 @@
 from hashlib import sha256
-from re import match
 import plyvel
 from binascii import hexlify, unhexlify
-from base58 import b58encode
-import sys
+from base58 import b58encode, b58decode
+import bech32
+import os
+import shutil
+import time
+import threading
+from stats import Stats, PROGRESS_EVERY
 
 # THIS functions are from bitcoin_tools and was only mildly changed.
 # Please refer to readme.md for the proper link to that library.
@@ -11,6 +15,71 @@ import sys
 # Fee per byte range
 NSPECIALSCRIPTS = 6
 
+# Type used in the types filters for the outputs with a raw script holding a witness program (SegWit, Taproot). All the
+# other raw scripts have no address.
+WITNESS = NSPECIALSCRIPTS
+
+# Address keys are a type byte followed by the address hash:
+#   - the version byte and the hash160 for P2PKH and P2SH (21 bytes)
+#   - 0x40 + witness version and the 20 byte witness program (P2WPKH), or 0x80 + witness version and the 32 byte
+#     witness program (P2WSH, P2TR)
+# Outputs to a public key (P2PK) have no address, they are all aggregated under the P2PK key (no hash).
+P2PKH_PREFIX = b'\x00'
+P2SH_PREFIX = b'\x05'
+P2PK_KEY = b'\xff'
+ADDRESS_KEY_SIZE = 33
+
+ADDRESS_KEY_TYPES = {0x00: 'p2pkh', 0x05: 'p2sh', 0xff: 'p2pk', 0x40: 'p2wpkh', 0x80: 'p2wsh', 0x81: 'p2tr'}
+
+# Witness programs are recognized by the first two bytes of the raw script, the version opcode (OP_0, OP_1 - OP_16)
+# and the push of the program: they give the address key type byte and the expected script length.
+WITNESS_SCRIPTS = dict(
+    (bytes(bytearray([opcode, size])), (bytes(bytearray([type_base + version])), size + 2))
+    for version, opcode in enumerate([0x00] + list(range(0x51, 0x61)))
+    for size, type_base in ((20, 0x40), (32, 0x80))
+)
+
+# Chainstate keys of the best block hash, and of the blocks being flushed (only present while a flush is in progress,
+# the UTXO set is then a mix of two tips)
+DB_BEST_BLOCK = b'B'
+DB_HEAD_BLOCKS = b'H'
+
+# Read tuning of a scan of the chainstate (see open_chainstate), every option can be overridden:
+#   - fill_cache: keep the blocks read in the block cache. A scan reads every block once, in key order, so by default
+#     they are not cached (they would only evict each other).
+#   - lru_cache_size: size of the block cache in bytes, None for the LevelDB default (8 MB).
+#   - block_size: block size of the tables written while the chainstate is open (recovery of the log, compactions),
+#     None for the LevelDB default (4 KB). The existing tables keep their block size.
+#   - max_open_files: size of the table cache. A mainnet chainstate has several thousand table files, more than the
+#     LevelDB default (1000), so tables would be reopened. It is capped by the open files limit of the process.
+#   - readahead: ask the kernel to load the table files in the page cache, in the background, while they are scanned.
+#     This turns the reads of the scan into sequential reads (spinning disks, network volumes) when the chainstate fits
+#     in memory. Only where posix_fadvise is available.
+SCAN_TUNING = {
+    'fill_cache': False,
+    'lru_cache_size': None,
+    'block_size': None,
+    'max_open_files': 4096,
+    'readahead': False,
+}
+
+# File descriptors kept for the rest of the process when max_open_files is capped
+RESERVED_FILES = 64
+
+# A copy of the chainstate of a running node is retried when it is not consistent (see clone_live_chainstate)
+LIVE_CLONE_ATTEMPTS = 10
+LIVE_CLONE_DELAY = 2.0
+
+# Typecode of the arrays of amounts
+UINT64 = 'Q'
+
+
+def to_str(data):
+    """ Gets the native string of ASCII data, e.g. the bytes returned by b58encode or hexlify on Python 3.
+    """
+
+    return data if isinstance(data, str) else data.decode('ascii')
+
 
 def txout_decompress(x):
     """ Decompresses the Satoshi amount of a UTXO stored in the LevelDB. Code is a port from the Bitcoin Core C++
@@ -27,10 +96,10 @@ def txout_decompress(x):
         return 0
     x -= 1
     e = x % 10
-    x /= 10
+    x //= 10
     if e < 9:
         d = (x % 9) + 1
-        x /= 9
+        x //= 9
         n = x * 10 + d
     else:
         n = x + 1
@@ -41,9 +110,9 @@ def txout_decompress(x):
 
 
 def b128_decode(data):
-    """ Performs the MSB base-128 decoding of a given value. Used to decode variable integers (varints) from the LevelDB.
-    The code is a port from the Bitcoin Core C++ source. Notice that the code is not exactly the same since the original
-    one reads directly from the LevelDB.
+    """ Performs the MSB base-128 decoding of a given value. Used to decode variable integers (varints) from the
+    LevelDB. The code is a port from the Bitcoin Core C++ source. Notice that the code is not exactly the same since the
+    original one reads directly from the LevelDB.
 
     The decoding is used to decode Satoshi amounts stored in the Bitcoin LevelDB (chainstate). After decoding, values
     are decompressed using txout_decompress.
@@ -98,6 +167,126 @@ def parse_b128(utxo, offset=0):
     return data, offset
 
 
+def read_b128(data, offset=0):
+    """ Reads and decodes a base-128 varint straight from raw bytes, without going through its hex representation.
+    This is the bytes counterpart of parse_b128 + b128_decode and it is the one used when scanning the chainstate.
+
+    :param data: Serialized data from which the varint will be read.
+    :type data: bytes
+    :param offset: Index of the first byte of the varint in data.
+    :type offset: int
+    :return: The decoded value, and the index of the byte located right after it.
+    :rtype: int, int
+    """
+
+    n = 0
+    while True:
+        d = data[offset]
+        offset += 1
+        n = n << 7 | d & 0x7F
+        if d & 0x80:
+            n += 1
+        else:
+            return n, offset
+
+
+def read_script(data, offset):
+    """ Reads the (compressed) script type and the script following it from raw bytes. See decode_utxo for the
+    meaning of the different script types.
+
+    :param data: Serialized coin from which the script will be read.
+    :type data: bytes
+    :param offset: Index of the script type varint in data.
+    :type offset: int
+    :return: The script type, the script, and the index of the byte located right after it.
+    :rtype: int, bytes, int
+    """
+
+    out_type, offset = read_b128(data, offset)
+
+    if out_type in (0, 1):
+        data_size = 20
+    elif out_type in (2, 3, 4, 5):
+        data_size = 33  # 1 byte for the type + 32 bytes of data
+        offset -= 1
+    else:
+        data_size = out_type - NSPECIALSCRIPTS
+
+    end = offset + data_size
+    return out_type, bytes(data[offset:end]), end
+
+
+def decode_coin(coin):
+    """ Decodes a raw (already de-obfuscated) coin for Bitcoin core v 0.15 onwards. This is the bytes counterpart of
+    decode_utxo, it only decodes the coin itself (the outpoint is not needed to get the balances) and returns a plain
+    tuple instead of building dictionaries.
+
+    :param coin: The coin to be decoded (extracted from the chainstate).
+    :type coin: bytes
+    :return: The block height, the coinbase flag, the amount of satoshi, the script type and the script.
+    :rtype: int, int, int, int, bytes
+    """
+
+    code, offset = read_b128(coin)
+    value, offset = read_b128(coin, offset)
+    out_type, script, offset = read_script(coin, offset)
+
+    assert offset == len(coin)
+
+    return code >> 1, code & 0x01, txout_decompress(value), out_type, script
+
+
+# The compiled decoder is used when it is built (see _coins.c), the pure Python one is kept for the comparisons.
+py_decode_coin = decode_coin
+try:
+    from _coins import decode_coin
+except ImportError:
+    pass
+
+
+def decode_coin_v08_v014(utxo):
+    """ Decodes a raw (already de-obfuscated) UTXO for Bitcoin core v 0.08 - v 0.14. This is the bytes counterpart of
+    decode_utxo_v08_v014.
+
+    :param utxo: UTXO to be decoded (extracted from the chainstate).
+    :type utxo: bytes
+    :return: The block height, the coinbase flag, and a list of (index, amount, script type, script) for every
+        non-spent output.
+    :rtype: int, int, list
+    """
+
+    _, offset = read_b128(utxo)
+    code, offset = read_b128(utxo, offset)
+    coinbase = code & 0x01
+
+    vout = [i for i, bit in enumerate((code & 0x02, code & 0x04)) if bit]
+    n = code >> 3
+    if not vout:
+        n += 1
+
+    # Every set bit j of the (LE) unspentness bitvector encodes the non-spent output j + 2. Zero bytes do not count
+    # towards n.
+    base = 2
+    while n:
+        d = utxo[offset]
+        offset += 1
+        if d:
+            n -= 1
+            vout.extend(base + j for j in range(8) if d >> j & 1)
+        base += 8
+
+    outs = []
+    for i in vout:
+        value, offset = read_b128(utxo, offset)
+        out_type, script, offset = read_script(utxo, offset)
+        outs.append((i, txout_decompress(value), out_type, script))
+
+    height, offset = read_b128(utxo, offset)
+    assert offset == len(utxo)
+
+    return height, coinbase, outs
+
+
 def decode_utxo(coin, outpoint, version=0.15):
     """
     Decodes a LevelDB serialized UTXO for Bitcoin core v 0.15 onwards. The serialized format is defined in the Bitcoin
@@ -127,11 +316,13 @@ def decode_utxo(coin, outpoint, version=0.15):
     :rtype: dict
     """
 
+    coin = to_str(coin)
     if 0.08 <= version < 0.15:
         return decode_utxo_v08_v014(coin)
     elif version < 0.08:
         raise Exception("The utxo decoder only works for version 0.08 onwards.")
     else:
+        outpoint = to_str(outpoint)
         # First we will parse all the data encoded in the outpoint, that is, the transaction id and index of the utxo.
         # Check that the input data corresponds to a transaction.
         assert outpoint[:2] == '43'
@@ -217,6 +408,8 @@ def decode_utxo_v08_v014(utxo):
     :rtype: dict
     """
 
+    utxo = to_str(utxo)
+
     # Version is extracted from the first varint of the serialized utxo
     version, offset = parse_b128(utxo)
     version = b128_decode(version)
@@ -238,7 +431,7 @@ def decode_utxo_v08_v014(utxo):
         vout = []
     else:
         n = code >> 3
-        vout = [i for i in xrange(len(vout)) if vout[i] is not 0]
+        vout = [i for i in range(len(vout)) if vout[i] != 0]
 
     # If n is set, the encoded value contains a bitvector. The following bytes are parsed until n non-zero bytes have
     # been extracted. (If a 00 is found, the parsing continues but n is not decreased)
@@ -258,7 +451,7 @@ def decode_utxo_v08_v014(utxo):
         # Every position (i) with a 1 encodes the index of a non-spent output as i+2, since the two first outs (v[0] and
         # v[1] has been already counted)
         # (e.g: 0440 (LE) = 4004 (BE) = 0100 0000 0000 0100. It encodes outs 4 (i+2 = 2+2) and 16 (i+2 = 14+2).
-        extended_vout = [i+2 for i in xrange(len(bin_data))
+        extended_vout = [i+2 for i in range(len(bin_data))
                          if bin_data.find('1', i) == i]  # Finds the index of '1's and adds 2.
 
         # Finally, the first two vouts are included to the list (if they are non-spent).
@@ -301,81 +494,478 @@ def decode_utxo_v08_v014(utxo):
     return {'version': version, 'coinbase': coinbase, 'outs': outs, 'height': height}
 
 
-def parse_ldb(fin_name, version=0.15, types=(0, 1)):
-    counter = 0
+def utxo_prefix(version):
+    """ Returns the key prefix of the UTXO entries in the chainstate of the given Bitcoin Core version.
+
+    :param version: Bitcoin Core version that created the chainstate LevelDB.
+    :type version: float
+    :return: The key prefix.
+    :rtype: bytes
+    """
+
     if 0.08 <= version < 0.15:
-        prefix = b'c'
+        return b'c'
     elif version < 0.08:
         raise Exception("The utxo decoder only works for version 0.08 onwards.")
     else:
-        prefix = b'C'
+        return b'C'
 
-    # Open the LevelDB
-    db = plyvel.DB(fin_name, compression=None)  # Change with path to chainstate
+
+def split_key_range(prefix, parts):
+    """ Splits the UTXO key space into disjoint ranges by the first byte of the transaction id following the prefix.
+
+    :param prefix: Key prefix of the UTXO entries (see utxo_prefix).
+    :type prefix: bytes
+    :param parts: Number of ranges.
+    :type parts: int
+    :return: List of (start, stop) keys, start inclusive and stop exclusive, in key order.
+    :rtype: list
+    """
+
+    parts = max(1, min(parts, 256))
+    bounds = [256 * i // parts for i in range(parts + 1)]
+    keys = [prefix + bytes(bytearray([b])) for b in bounds[:-1]]
+    # The last range is closed by the next prefix, so that it includes the keys starting with 0xff.
+    keys.append(bytes(bytearray([bytearray(prefix)[0] + 1])))
+
+    return list(zip(keys[:-1], keys[1:]))
+
+
+def clone_chainstate(fin_name, dest):
+    """ Makes a private copy of the chainstate LevelDB that can be opened while the original is open elsewhere
+    (LevelDB allows a single process per database). Table files are never modified by LevelDB once written, so they are
+    hard-linked when possible; the rest of the files (manifest, log, ...) are copied.
+
+    :param fin_name: Path to the chainstate directory.
+    :type fin_name: str
+    :param dest: Path to the (non-existing) directory where the copy will be made.
+    :type dest: str
+    :return: dest
+    :rtype: str
+    """
+
+    os.mkdir(dest)
+    for name in os.listdir(fin_name):
+        src = os.path.join(fin_name, name)
+        dst = os.path.join(dest, name)
+        if name == 'LOCK' or not os.path.isfile(src):
+            continue
+        if name.endswith(('.ldb', '.sst')):
+            try:
+                os.link(src, dst)
+                continue
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    return dest
+
+
+def clone_live_chainstate(fin_name, dest, attempts=LIVE_CLONE_ATTEMPTS, delay=LIVE_CLONE_DELAY):
+    """ Makes a consistent, point-in-time copy of the chainstate of a running node (see clone_chainstate). The node
+    keeps writing while the files are linked and copied: a table file may be removed by a compaction, the manifest may
+    be replaced, or a flush may be in progress. The copy is then opened (which recovers its log) and retried until it
+    opens and holds a best block without a flush in progress.
+
+    :param fin_name: Path to the chainstate directory.
+    :type fin_name: str
+    :param dest: Path to the (non-existing) directory where the copy will be made, on the same filesystem as the
+        chainstate so that the table files are hard-linked rather than copied.
+    :type dest: str
+    :param attempts: Number of copies tried.
+    :type attempts: int
+    :param delay: Seconds waited between the copies.
+    :type delay: float
+    :return: dest
+    :rtype: str
+    """
+
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(delay)
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        try:
+            clone_chainstate(fin_name, dest)
+            db = plyvel.DB(dest, compression=None)
+            try:
+                if db.get(DB_HEAD_BLOCKS) is None and db.get(DB_BEST_BLOCK) is not None:
+                    return dest
+            finally:
+                db.close()
+        except (IOError, OSError, plyvel.Error):
+            # Files changed during the copy, plyvel errors are raised for missing or corrupted files
+            pass
+
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    raise Exception('unable to make a consistent copy of %s in %d attempts' % (fin_name, attempts))
+
+
+def address_key(out_type, script):
+    """ Gets the address key (see encode_address_key) of a decoded output.
+
+    :param out_type: Script type of the output.
+    :type out_type: int
+    :param script: Script of the output.
+    :type script: bytes
+    :return: The address key, or None if the output has no known address.
+    :rtype: bytes
+    """
+
+    # 0 --> P2PKH
+    # 1 --> P2SH
+    # 2 - 3 --> P2PK(Compressed keys)
+    # 4 - 5 --> P2PK(Uncompressed keys)
+    # 6 onwards --> raw script, with an address only for witness programs
+    if out_type == 0:
+        return P2PKH_PREFIX + script
+    elif out_type == 1:
+        return P2SH_PREFIX + script
+    elif out_type < NSPECIALSCRIPTS:
+        return P2PK_KEY
+
+    witness = WITNESS_SCRIPTS.get(script[:2])
+    if witness is not None and witness[1] == len(script):
+        return witness[0] + script[2:]
+    return None
+
+
+def chainstate_deobfuscator(db):
+    """ Gets the function de-obfuscating the values of an opened chainstate LevelDB.
+
+    :param db: The chainstate LevelDB.
+    :type db: plyvel.DB
+    :return: A function taking an obfuscated value (bytes) and returning the de-obfuscated value (bytes).
+    :rtype: function
+    """
 
     # Load obfuscation key (if it exists)
-    o_key = db.get((unhexlify("0e00") + "obfuscate_key"))
+    o_key = db.get(b'\x0e\x00obfuscate_key')
 
     # If the key exists, the leading byte indicates the length of the key (8 byte by default). If there is no key,
-    # 8-byte zeros are used (since the key will be XORed with the given values).
-    if o_key is not None:
-        o_key = hexlify(o_key)[2:]
+    # the values are not obfuscated.
+    if o_key is None:
+        return bytearray
+    return deobfuscator(o_key[1:])
+
+
+def read_best_block(fin_name):
+    """ Gets the hash of the block the chainstate is up to date with.
+
+    :param fin_name: Path to the chainstate directory.
+    :type fin_name: str
+    :return: The block hash (hex, in the usual byte order of block explorers), or None if the chainstate has none.
+    :rtype: str
+    """
+
+    db = plyvel.DB(fin_name, compression=None)
+    try:
+        value = db.get(DB_BEST_BLOCK)
+        if value is None:
+            return None
+        return to_str(hexlify(bytes(chainstate_deobfuscator(db)(value))[::-1]))
+    finally:
+        db.close()
+
+
+def scan_tuning(tuning=None):
+    """ Gets the read tuning of a scan: SCAN_TUNING, overridden by the given options.
+
+    :param tuning: Options overriding the defaults, see SCAN_TUNING.
+    :type tuning: dict
+    :return: All the options.
+    :rtype: dict
+    """
+
+    options = dict(SCAN_TUNING)
+    for name, value in (tuning or {}).items():
+        if name not in options:
+            raise Exception('unknown read option %s' % name)
+        options[name] = value
+    return options
+
+
+def open_files_limit(wanted):
+    """ Raises the open files limit of the process (up to its hard limit) so that LevelDB can keep wanted files open.
+
+    :param wanted: Number of files LevelDB should keep open.
+    :type wanted: int
+    :return: The number of files LevelDB can keep open within the limit.
+    :rtype: int
+    """
+
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return wanted
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted + RESERVED_FILES:
+        soft = wanted + RESERVED_FILES if hard == resource.RLIM_INFINITY else min(wanted + RESERVED_FILES, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        except (ValueError, OSError):
+            soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(min(wanted, soft - RESERVED_FILES), 16)
+
+
+def prefetch_tables(fin_name):
+    """ Asks the kernel to read the table files of a LevelDB into the page cache, from a background thread. Does
+    nothing where posix_fadvise is not available.
+
+    :param fin_name: Path to the LevelDB directory.
+    :type fin_name: str
+    :return: The thread, or None.
+    :rtype: threading.Thread
+    """
+
+    if not hasattr(os, 'posix_fadvise'):
+        return None
+
+    # Tables are numbered in the order they were written, which is about their order on disk
+    names = sorted(name for name in os.listdir(fin_name) if name.endswith(('.ldb', '.sst')))
+
+    def prefetch():
+        for name in names:
+            try:
+                fd = os.open(os.path.join(fin_name, name), os.O_RDONLY)
+            except OSError:
+                # Removed by a compaction
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    thread = threading.Thread(target=prefetch)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def open_chainstate(fin_name, tuning=None):
+    """ Opens a chainstate LevelDB for a scan.
+
+    :param fin_name: Path to the chainstate directory.
+    :type fin_name: str
+    :param tuning: Read options, see SCAN_TUNING.
+    :type tuning: dict
+    :return: The database, and the options of its iterators.
+    :rtype: plyvel.DB, dict
+    """
+
+    tuning = scan_tuning(tuning)
+    options = {'max_open_files': open_files_limit(tuning['max_open_files'])}
+    for name in ('lru_cache_size', 'block_size'):
+        if tuning[name] is not None:
+            options[name] = tuning[name]
+
+    db = plyvel.DB(fin_name, compression=None, **options)
+    if tuning['readahead']:
+        prefetch_tables(fin_name)
+    return db, {'fill_cache': tuning['fill_cache']}
+
+
+class OutputDecoder(object):
+    """
+    Decodes raw (obfuscated) chainstate values into the (address key, amount, height) records of the outputs of the
+    given types, see parse_ldb. The coins, the outputs and the highest height are counted, as well as the outputs which
+    could not be decoded (not_decoded, count and total amount). The counters are updated when an iteration ends.
+
+    For timed stats, clock is Stats.clock: the de-obfuscation and the decoding are accounted, the time between the
+    values to the reader stage and the time between the records to the consumer stage. Progress, if given, is called
+    with the number of outputs every PROGRESS_EVERY outputs.
+    """
+
+    def __init__(self, deobfuscate, version=0.15, types=(0, 1), keys=None, clock=None, progress=None,
+                 reader='iterate', consumer='aggregate'):
+        self.deobfuscate = deobfuscate
+        self.version = version
+        self.types = types
+        self.keys = keys
+        self.clock = clock
+        self.progress = progress
+        self.reader = reader
+        self.consumer = consumer
+        self.entries = 0
+        self.outputs = 0
+        self.max_height = 0
+        self.not_decoded = [0, 0]
+
+    def iter_outputs(self, o_values):
+        """ Iterates over the records of the outputs of the given values.
+
+        :param o_values: Raw values of the chainstate.
+        :type o_values: iterable
+        :return: Generator of (address key, amount, height).
+        :rtype: generator
+        """
+
+        deobfuscate = self.deobfuscate
+        version = self.version
+        types = self.types
+        keys = self.keys
+        clock = self.clock
+        progress = self.progress
+        reader = self.reader
+        consumer = self.consumer
+        entries = self.entries
+        outputs = self.outputs
+        max_height = self.max_height
+        skipped = self.not_decoded
+
+        try:
+            if clock:
+                clock(reader)
+            for o_value in o_values:
+                if clock:
+                    clock('deobfuscate')
+                value = deobfuscate(o_value)
+                if clock:
+                    clock('decode')
+                entries += 1
+
+                if version < 0.15:
+                    height, _, outs = decode_coin_v08_v014(value)
+                else:
+                    height, _, amount, out_type, script = decode_coin(value)
+                    outs = ((0, amount, out_type, script),)
+                if height > max_height:
+                    max_height = height
+
+                for _, amount, out_type, script in outs:
+                    if progress is not None and not outputs & (PROGRESS_EVERY - 1):
+                        progress(outputs)
+                    outputs += 1
+
+                    key = address_key(out_type, script)
+                    if key is None:
+                        skipped[0] += 1
+                        skipped[1] += amount
+                    elif min(out_type, WITNESS) in types and (keys is None or key in keys):
+                        if clock:
+                            clock(consumer)
+                            yield key, amount, height
+                            clock('decode')
+                        else:
+                            yield key, amount, height
+                if clock:
+                    clock(reader)
+
+            if clock:
+                clock(consumer)
+        finally:
+            self.entries = entries
+            self.outputs = outputs
+            self.max_height = max_height
+
+    def add_to(self, stats):
+        """ Adds the counters to the stats of the run (see stats.Stats).
+        """
+
+        stats.add('utxo_entries', self.entries)
+        stats.add('outputs', self.outputs)
+        stats.add('not_decoded', self.not_decoded[0])
+        stats.add('not_decoded_satoshi', self.not_decoded[1])
+        stats.maximum('max_height', self.max_height)
+
+
+def parse_ldb(fin_name, version=0.15, types=(0, 1), start=None, stop=None, not_decoded=None, stats=None, keys=None,
+              tuning=None):
+    """ Iterates over the UTXO set in the chainstate and yields (address key, amount, height) for every output of the
+    given types. Address keys are the raw (binary) form of the addresses, see encode_address_key.
+
+    If start/stop keys are given (see split_key_range), only that part of the UTXO set is read. If a not_decoded list
+    is given, the count and total amount of the outputs which could not be decoded are added to it and neither the
+    progress nor the totals are printed. If stats (see stats.Stats) are given, the counters are added to them and, for
+    timed stats, the time spent reading, de-obfuscating and decoding is accounted; the time between the yields is
+    accounted to the aggregation. If a set of address keys is given (see load_watchlist), only the outputs to these
+    addresses are yielded. The LevelDB reads are tuned with the tuning options, see SCAN_TUNING.
+    """
+
+    prefix = utxo_prefix(version)
+    verbose = not_decoded is None
+    if stats is None:
+        stats = Stats(progress=verbose)
+    clock = stats.clock if stats.timed else None
+
+    # Open the LevelDB
+    db, read_options = open_chainstate(fin_name, tuning)  # Change with path to chainstate
+    decoder = OutputDecoder(chainstate_deobfuscator(db), version, types, keys, clock,
+                            stats.progress if verbose else None)
 
     # For every UTXO (identified with a leading 'c'), the key (tx_id) and the value (encoded utxo) is displayed.
     # UTXOs are obfuscated using the obfuscation key (o_key), in order to get them non-obfuscated, a XOR between the
     # value and the key (concatenated until the length of the value is reached) if performed).
-    not_decoded = [0, 0]
-    for key, o_value in db.iterator(prefix=prefix):
-        key = hexlify(key)
-        if o_key is not None:
-            value = deobfuscate_value(o_key, hexlify(o_value))
-        else:
-            value = hexlify(o_value)
+    # Values are decoded straight from the raw bytes, the outpoint (key) is not needed to get the balances.
+    if verbose:
+        not_decoded = [0, 0]
+    if start is None:
+        iterator = db.iterator(prefix=prefix, include_key=False, **read_options)
+    else:
+        iterator = db.iterator(start=start, stop=stop, include_key=False, **read_options)
+    for record in decoder.iter_outputs(iterator):
+        yield record
 
-        # If the decode flag is passed, we also decode the utxo before storing it. This is really useful when running
-        # a full analysis since will avoid decoding the whole utxo set twice (once for the utxo and once for the tx
-        # based analysis)
-        if version < 0.15:
-            value = decode_utxo_v08_v014(value)
-        else:
-            value = decode_utxo(value, key, version)
-
-        for out in value['outs']:
-            # 0 --> P2PKH
-            # 1 --> P2SH
-            # 2 - 3 --> P2PK(Compressed keys)
-            # 4 - 5 --> P2PK(Uncompressed keys)
-
-            if counter % 100 == 0:
-                sys.stdout.write('\r parsed transactions: %d' % counter)
-                sys.stdout.flush()
-            counter += 1
-
-            if out['out_type'] == 0:
-                if out['out_type'] not in types:
-                    continue
-                add = hash_160_to_btc_address(out['data'], 0)
-                yield add, out['amount'], value['height']
-            elif out['out_type'] == 1:
-                if out['out_type'] not in types:
-                    continue
-                add = hash_160_to_btc_address(out['data'], 5)
-                yield add, out['amount'], value['height']
-            elif out['out_type'] in (2, 3, 4, 5):
-                if out['out_type'] not in types:
-                    continue
-                add = 'P2PK'
-                yield add, out['amount'], value['height']
-            else:
-                not_decoded[0] += 1
-                not_decoded[1] += out['amount']
+    not_decoded[0] += decoder.not_decoded[0]
+    not_decoded[1] += decoder.not_decoded[1]
+    decoder.add_to(stats)
 
-    print('\nunable to decode %d transactions' % not_decoded[0])
-    print('totaling %d satoshi' % not_decoded[1])
+    if verbose:
+        stats.end_progress()
+        print('unable to decode %d transactions' % not_decoded[0])
+        print('totaling %d satoshi' % not_decoded[1])
 
     db.close()
 
 
+def deobfuscator(obfuscation_key):
+    """
+    Builds a de-obfuscation function for raw values parsed from the chainstate. This is the bytes counterpart of
+    deobfuscate_value.
+
+    The extended obfuscation key is not built for every value. Instead, the key stream is expanded once to the length of
+    the longest value seen so far, and the integer mask for every value length is computed once and kept, so each value
+    is de-obfuscated with a single integer XOR.
+
+    :param obfuscation_key: Key used to obfuscate the values (extracted from the chainstate, without the leading
+        length byte).
+    :type obfuscation_key: bytes
+    :return: A function taking an obfuscated value (bytes) and returning the de-obfuscated value (bytes).
+    :rtype: function
+    """
+
+    obfuscation_key = bytes(obfuscation_key)
+    key_stream = [obfuscation_key]
+    masks = {}
+
+    def deobfuscate(value):
+        l_value = len(value)
+        mask = masks.get(l_value)
+        if mask is None:
+            if len(key_stream[0]) < l_value:
+                key_stream[0] = obfuscation_key * (l_value // len(obfuscation_key) + 1)
+            mask = masks[l_value] = bytes_to_int(key_stream[0][:l_value])
+
+        return int_to_bytes(bytes_to_int(value) ^ mask, l_value)
+
+    return deobfuscate
+
+
+def bytes_to_int(data):
+    return int.from_bytes(data, 'big')
+
+
+def int_to_bytes(n, length):
+    return n.to_bytes(length, 'big')
+
+
 def deobfuscate_value(obfuscation_key, value):
     """
     De-obfuscate a given value parsed from the chainstate.
@@ -388,13 +978,15 @@ def deobfuscate_value(obfuscation_key, value):
     :rtype: str.
     """
 
+    obfuscation_key = to_str(obfuscation_key)
+    value = to_str(value)
     l_value = len(value)
     l_obf = len(obfuscation_key)
 
     # Get the extended obfuscation key by concatenating the obfuscation key with itself until it is as large as the
     # value to be de-obfuscated.
     if l_obf < l_value:
-        extended_key = (obfuscation_key * ((l_value / l_obf) + 1))[:l_value]
+        extended_key = (obfuscation_key * ((l_value // l_obf) + 1))[:l_value]
     else:
         extended_key = obfuscation_key[:l_value]
 
@@ -402,7 +994,7 @@ def deobfuscate_value(obfuscation_key, value):
 
     # In some cases, the obtained value could be 1 byte smaller than the original, since the leading 0 is dropped off
     # when the formatting.
-    if len(r) is l_value-1:
+    if len(r) == l_value-1:
         r = r.zfill(l_value)
 
     assert len(value) == len(r)
@@ -422,9 +1014,7 @@ def change_endianness(x):
     # If there is an odd number of elements, we make it even by adding a 0
     if (len(x) % 2) == 1:
         x += "0"
-    y = x.decode('hex')
-    z = y[::-1]
-    return z.encode('hex')
+    return hexlify(unhexlify(x)[::-1]).decode('ascii')
 
 
 def hash_160_to_btc_address(h160, v):
@@ -443,12 +1033,12 @@ def hash_160_to_btc_address(h160, v):
     :rtype: hex str
     """
 
-    # If h160 is passed as hex str, the value is converted into bytes.
-    if match('^[0-9a-fA-F]*$', h160):
+    # If h160 is passed as hex str (twice as long as the raw hash), the value is converted into bytes.
+    if len(h160) == 40:
         h160 = unhexlify(h160)
 
     # Add the network version leading the previously calculated RIPEMD-160 hash.
-    vh160 = chr(v) + h160
+    vh160 = bytes(bytearray([v])) + bytes(h160)
     # Double sha256.
     h = sha256(sha256(vh160).digest()).digest()
     # Add the two first bytes of the result as a checksum tailing the RIPEMD-160 hash.
@@ -456,4 +1046,98 @@ def hash_160_to_btc_address(h160, v):
     # Obtain the Bitcoin address by Base58 encoding the result
     addr = b58encode(addr)
 
-    return addr
+    return to_str(addr)
+
+
+def encode_address_key(key):
+    """ Encodes an address key, as yielded by parse_ldb, into the Bitcoin address. For P2PKH and P2SH the key already is
+    the version byte followed by the hash160, so it is checksummed and Base58 encoded as is. Witness programs are
+    Bech32 (version 0) or Bech32m encoded.
+
+    :param key: The address key.
+    :type key: bytes
+    :return: The corresponding Bitcoin address, or P2PK for outputs to a public key.
+    :rtype: str
+    """
+
+    if key == P2PK_KEY:
+        return 'P2PK'
+    key_type = bytearray(key[:1])[0]
+    if key_type & 0xc0:
+        # The witness version and program length were checked when the key was made (see WITNESS_SCRIPTS), the
+        # address is not decoded again to verify it as bech32.encode does.
+        version = key_type & 0x3f
+        spec = bech32.BECH32 if version == 0 else bech32.BECH32M
+        return bech32.bech32_encode('bc', [version] + bech32.convertbits(bytearray(key[1:]), 8, 5), spec)
+    return to_str(b58encode(key + sha256(sha256(key).digest()).digest()[:4]))
+
+
+def decode_address(address):
+    """ Decodes a Bitcoin address into its address key, the inverse of encode_address_key.
+
+    :param address: The address (Base58 P2PKH or P2SH, Bech32/Bech32m witness program, or P2PK).
+    :type address: str
+    :return: The address key, or None if the address is not valid.
+    :rtype: bytes
+    """
+
+    if address == 'P2PK':
+        return P2PK_KEY
+    if address[:3].lower() == 'bc1':
+        version, program = bech32.decode('bc', address.lower())
+        if version is None:
+            return None
+        witness = WITNESS_SCRIPTS.get(bytes(bytearray([0x50 + version if version else 0x00, len(program)])))
+        if witness is None:
+            return None
+        return witness[0] + bytes(bytearray(program))
+
+    try:
+        data = b58decode(address)
+    except ValueError:
+        return None
+    key = data[:-4]
+    if len(data) != 25 or data[:1] not in (P2PKH_PREFIX, P2SH_PREFIX) or \
+            sha256(sha256(key).digest()).digest()[:4] != data[-4:]:
+        return None
+    return key
+
+
+def load_watchlist(path):
+    """ Loads the address keys of a watchlist, a file with an address per line (the first column of a csv, e.g. the
+    output of btcposbal2csv, is also read). Lines which are not a valid address (e.g. the header) are ignored.
+
+    :param path: Path to the watchlist file.
+    :type path: str
+    :return: The address keys, and the number of ignored lines.
+    :rtype: frozenset, int
+    """
+
+    keys = set()
+    ignored = 0
+    with open(path, 'r') as f:
+        for line in f:
+            address = line.split(',', 1)[0].strip()
+            if not address:
+                continue
+            key = decode_address(address)
+            if key is None:
+                ignored += 1
+            else:
+                keys.add(key)
+    return frozenset(keys), ignored
+
+
+def address_key_type(key):
+    """ Gets the script type of an address key (see encode_address_key).
+
+    :param key: The address key.
+    :type key: bytes
+    :return: p2pkh, p2sh, p2pk, p2wpkh, p2wsh, p2tr, or witness_v<version> for other witness programs.
+    :rtype: str
+    """
+
+    key_type = bytearray(key[:1])[0]
+    if key_type in ADDRESS_KEY_TYPES:
+        return ADDRESS_KEY_TYPES[key_type]
+    return 'witness_v%d' % (key_type & 0x3f)